@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+'''
+title:    run_bench.py
+purpose:  - Measure gpu_d's polling overhead without an NVIDIA card or X server. The fake
+            nvidia-settings in this directory is put first on PATH and fed a thermal trace,
+            gpu_d runs headless (--daemon, the same event loop and tick scheduling the screen
+            uses) for a while, is stopped with SIGTERM and the results are written as JSON so
+            runs of different versions can be compared.
+
+          - Reported per latency setting: nvidia-settings processes started (in total and per
+            tick), ticks, time to the first tick, tick/sample/fan write latency percentiles
+            from gpu_d's --metrics-file, control period overruns and CPU seconds per hour of
+            gpu_d itself and of the processes it started.
+
+usage:
+
+            python bench/run_bench.py [--duration=60] [--latency=0,0.05] [--gpus=2]
+                                      [--trace=file] [--output=file] [-- gpu_d options]
+
+            e.g. python bench/run_bench.py --latency=0,0.1 -- --min-period=1 --max-period=10
+
+            Run it with the Python gpu_d runs on (2.7) or name that with --python. Without
+            --trace a synthetic trace is made, a slow temperature swing per card with steps in
+            load so the adaptive period has something to adapt to.
+'''
+
+from __future__ import print_function, division
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(os.path.dirname(bench_dir), 'gpu_d_0.1n.py')
+clock_ticks = os.sysconf('SC_CLK_TCK')
+# ----------------------------------------------------------------------------------------
+def make_trace(path, gpus, seconds=600):
+    # one reading a second per card: temperature swinging 8 C either side of 65 over five
+    # minutes, utilization stepping between idle and full load every two minutes
+    with open(path, 'w') as f:
+        for t in range(seconds):
+            for gpu in range(gpus):
+                load = 95 if (t // 120 + gpu) % 2 else 5
+                temp = int(round(65 + 8 * math.sin(2 * math.pi * t / 300 + gpu)))
+                f.write(json.dumps({'gpu': gpu, 'time': t, 'temp': temp, 'fan': 70, 'rpm': None,
+                                    'gfx_clock': 1058 if load > 50 else 324, 'mem_clock': 3004,
+                                    'mem_used': 512, 'util': {'graphics': load, 'memory': load // 3,
+                                                              'video': 0, 'PCIe': 1}}) + '\n')
+# ----------------------------------------------------------------------------------------
+def cpu_seconds(pid):
+    # (own, reaped children) CPU seconds of a running process from /proc/pid/stat
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rpartition(')')[2].split()
+    utime, stime, cutime, cstime = [int(v) for v in fields[11:15]]
+    return (utime + stime) / clock_ticks, (cutime + cstime) / clock_ticks
+# ----------------------------------------------------------------------------------------
+def read_metrics(path):
+    # {(metric, labels): value} from a Prometheus text file
+    values = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r'(\w+)(\{[^}]*\})? (\S+)$', line.strip())
+            if m: values[(m.group(1), m.group(2) or '')] = float(m.group(3))
+    return values
+# ----------------------------------------------------------------------------------------
+def total(values, metric, match=''):
+    return sum(v for (name, labels), v in values.items() if name == metric and match in labels)
+# ----------------------------------------------------------------------------------------
+def percentiles(values, phase):
+    # worst of the cards' p50/p95/p99 in milliseconds
+    result = {}
+    for q, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+        found = [v for (name, labels), v in values.items() if name == 'gpu_d_phase_seconds' and
+                 'phase="%s"' % phase in labels and 'quantile="%s"' % q in labels]
+        result[key] = round(max(found) * 1000, 3) if found else None
+    return result
+# ----------------------------------------------------------------------------------------
+def run(args, latency, trace, work):
+    state = os.path.join(work, 'state-%g.json' % latency)
+    metrics = os.path.join(work, 'metrics-%g.prom' % latency)
+    logfile = os.path.join(work, 'gpu_d-%g.log' % latency)
+    env = dict(os.environ, PATH=bench_dir + os.pathsep + os.environ.get('PATH', ''),
+               FAKE_NVS_TRACE=trace, FAKE_NVS_STATE=state, FAKE_NVS_LATENCY=str(latency))
+    command = [args.python, script, str(args.target), '--daemon', '--metrics-file=' + metrics] + args.gpu_d
+    with open(logfile, 'w') as log:
+        started = time.time()
+        proc = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+        time.sleep(args.duration)
+        if proc.poll() is not None:
+            raise RuntimeError('gpu_d exited early, see ' + logfile + ':\n' + open(logfile).read()[-2000:])
+        own, children = cpu_seconds(proc.pid)
+        wall = time.time() - started
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+    with open(state) as f:
+        calls = json.load(f)
+    values = read_metrics(metrics)
+    ticks = total(values, 'gpu_d_phase_seconds_count', 'phase="tick"')
+    return {'latency': latency,
+            'wall_seconds': round(wall, 3),
+            'ticks': int(ticks),
+            'first_tick_seconds': values.get(('gpu_d_first_tick_seconds', '')),
+            'nvidia_settings_calls': calls['calls'],
+            'nvidia_settings_queries': calls['queries'],
+            'nvidia_settings_assigns': calls['assigns'],
+            'subprocesses_per_tick': round(calls['calls'] / ticks, 3) if ticks else None,
+            'tick_ms': percentiles(values, 'tick'),
+            'sample_ms': percentiles(values, 'sample'),
+            'fan_write_ms': percentiles(values, 'fan_write'),
+            'overruns': int(total(values, 'gpu_d_tick_overruns_total')),
+            'cpu_seconds_per_hour': round(own / wall * 3600, 3),
+            'subprocess_cpu_seconds_per_hour': round(children / wall * 3600, 3),
+            'exit_code': proc.returncode}
+# ----------------------------------------------------------------------------------------
+def version():
+    # what's being measured, the script's hash and the git commit if there is one
+    with open(script, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(script),
+                                         stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'script_sha1': digest, 'git_commit': commit}
+# ----------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='benchmark gpu_d against a fake nvidia-settings')
+    parser.add_argument('--duration', type=float, default=60, help='seconds gpu_d runs per latency setting')
+    parser.add_argument('--latency', default='0', help='comma separated seconds each nvidia-settings call takes')
+    parser.add_argument('--gpus', type=int, default=2, help='cards in the synthetic trace')
+    parser.add_argument('--trace', help='trace recorded with gpu_d --record instead of the synthetic one')
+    parser.add_argument('--target', type=int, default=65, help='target temperature')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run gpu_d with')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('gpu_d', nargs=argparse.REMAINDER, help='options passed to gpu_d after --')
+    args = parser.parse_args()
+    if args.gpu_d[:1] == ['--']: args.gpu_d = args.gpu_d[1:]
+
+    work = tempfile.mkdtemp(prefix='gpu_d-bench-')
+    try:
+        trace = args.trace
+        if not trace:
+            trace = os.path.join(work, 'trace.jsonl')
+            make_trace(trace, args.gpus)
+        report = version()
+        report.update({'time': time.time(), 'python': args.python, 'duration': args.duration,
+                       'trace': args.trace or 'synthetic, %d GPU(s)' % args.gpus, 'gpu_d_options': args.gpu_d,
+                       'runs': [run(args, float(latency), trace, work) for latency in args.latency.split(',')]})
+    finally:
+        shutil.rmtree(work)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+# ----------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
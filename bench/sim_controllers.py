@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+title:    sim_controllers.py
+purpose:  - Score gpu_d's fan rules (--controller) against the simulated card, SimBackend's
+            ThermalPlant, on every load profile in load_profiles. The script's own
+            GpuController, AdaptiveScheduler and CachedBackend are used, only the clock is
+            replaced so half an hour of control runs in well under a second.
+
+          - Scores per rule and profile:
+                settle_s        seconds from a step in load until the temperature is back in the
+                                band for good (mean and max over the steps of the profile)
+                unsettled       steps after which it never got back in the band
+                overshoot_c     most degrees above target
+                out_of_band_s   seconds outside target +/- tolerance while the fan wasn't pinned
+                                at the limit that would have helped
+                fan_changes     ticks that changed the fan speed
+                mean_fan        average fan speed, %
+
+usage:
+
+            python bench/sim_controllers.py [--controllers=step,pid] [--profiles=job_start,...]
+                                            [--target=70] [--duration=1800] [--output=file]
+
+            Needs Python 2.7 like gpu_d itself.
+'''
+
+from __future__ import print_function, division
+import argparse
+import imp
+import json
+import os
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+gpu_d = imp.load_source('gpu_d', os.path.join(os.path.dirname(bench_dir), 'gpu_d_0.1n.py'))
+step = 0.5                  # seconds of simulated time between looks at the plant
+# ----------------------------------------------------------------------------------------
+def simulate(rule, profile, args):
+    # one card, one rule, one profile, returns a row per step: (time, util, temperature read, fan)
+    clock = [0.0]
+    gpu_d.time = lambda: clock[0]
+    gpu_d.fan_rule = rule
+    gpu_d.target_temp, gpu_d.tolerance = args.target, args.tolerance
+    sim = gpu_d.SimBackend([profile])
+    gpu_d.backend = gpu_d.CachedBackend(sim)
+    c = gpu_d.make_controllers([0], None)[0]
+    c.start()
+    rows, changes, next_tick = [], 0, 0
+    while clock[0] < args.duration:
+        if clock[0] >= next_tick:
+            c.tick()
+            changes += c.speed_delta != 0
+            next_tick = c.tick_started + c.period
+        plant = sim.plants[0]
+        plant.advance(clock[0])
+        rows.append((clock[0], plant.util(), int(round(plant.die)), c.current_speed))
+        clock[0] += step
+    return rows, changes, c
+# ----------------------------------------------------------------------------------------
+def score(rows, changes, c):
+    def in_band(temp, fan):
+        # a card the fan can't help any further counts as in the band
+        return (abs(temp - c.target) <= c.tolerance or (temp < c.target and fan <= c.fan_low) or
+                (temp > c.target and fan >= c.fan_high))
+    steps = [i for i in range(1, len(rows)) if abs(rows[i][1] - rows[i - 1][1]) >= 20]
+    settle, unsettled = [], 0
+    for n, start in enumerate(steps):
+        end = steps[n + 1] if n + 1 < len(steps) else len(rows)
+        out = [i for i in range(start, end) if not in_band(rows[i][2], rows[i][3])]
+        if out and out[-1] == end - 1:
+            unsettled += 1
+        settle.append((out[-1] - start + 1) * step if out else 0)
+    return {'settle_s_mean': round(sum(settle) / len(settle), 1) if settle else 0,
+            'settle_s_max': max(settle) if settle else 0,
+            'unsettled': unsettled,
+            'overshoot_c': max(0, max(r[2] for r in rows) - c.target),
+            'out_of_band_s': sum(step for r in rows if not in_band(r[2], r[3])),
+            'fan_changes': changes,
+            'mean_fan': round(sum(r[3] for r in rows) / len(rows), 1)}
+# ----------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='score gpu_d fan rules on a simulated card')
+    parser.add_argument('--controllers', default='step,pid', help='comma separated --controller specs')
+    parser.add_argument('--profiles', default=','.join(sorted(gpu_d.load_profiles)), help='load profiles')
+    parser.add_argument('--target', type=int, default=70, help='target temperature')
+    parser.add_argument('--tolerance', type=int, default=1, help='tolerance, C')
+    parser.add_argument('--duration', type=float, default=1800, help='simulated seconds per run')
+    parser.add_argument('--output', help='also write the scores as JSON here')
+    args = parser.parse_args()
+
+    results = []
+    columns = ('settle_s_mean', 'settle_s_max', 'unsettled', 'overshoot_c', 'out_of_band_s',
+               'fan_changes', 'mean_fan')
+    print('%-22s %-10s' % ('controller', 'profile') + ''.join('%14s' % k for k in columns))
+    for rule in args.controllers.split(','):
+        totals = dict.fromkeys(columns, 0)
+        for profile in args.profiles.split(','):
+            result = score(*simulate(rule, profile, args))
+            print('%-22s %-10s' % (rule, profile) + ''.join('%14s' % result[k] for k in columns))
+            results.append(dict(result, controller=rule, profile=profile))
+            for k in columns: totals[k] += result[k]
+        print('%-22s %-10s' % (rule, 'total') + ''.join('%14s' % round(totals[k], 1) for k in columns))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'target': args.target, 'tolerance': args.tolerance, 'duration': args.duration,
+                       'results': results}, f, indent=2, sort_keys=True)
+# ----------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+'''
+title:    sim_governor.py
+purpose:  - Compare ways of keeping a card at its target when the fan alone can't, on the
+            simulated card (SimBackend's ThermalPlant) in a hot room, for every load profile:
+                none        let it run hot
+                suspend     all or nothing, suspend GPU work while the fan is at its limit and
+                            the card above its band, resume once it's below the band, what
+                            --on-fan-failure=boinc and the usual BOINC temperature tools do
+                boinc       gpu_d's LoadGovernor duty-cycling BOINC (--throttle=boinc)
+            boinccmd is replaced by a function suspending the plant and the clock is virtual,
+            the rest is gpu_d's own GpuController, fan rule and apply_throttle(). A suspended
+            task takes ThermalPlant.resume_lag seconds to get going again.
+
+          - Scores per policy and profile:
+                work_pct        work done (utilization x time) as a percentage of what the
+                                profile asked for, from the plant
+                measured_pct    the same from gpu_d's own count (GpuController.work)
+                mean_c          average temperature while the profile asked for load
+                over_band_s     seconds above target + tolerance
+                max_c           hottest reading
+                suspends        times GPU work was suspended
+
+usage:
+
+            python bench/sim_governor.py [--policies=none,suspend,boinc] [--profiles=full,...]
+                                         [--ambient=40] [--target=70] [--controller=pid]
+                                         [--duration=3600] [--output=file]
+
+            Needs Python 2.7 like gpu_d itself.
+'''
+
+from __future__ import print_function, division
+import argparse
+import imp
+import json
+import os
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+gpu_d = imp.load_source('gpu_d', os.path.join(os.path.dirname(bench_dir), 'gpu_d_0.1n.py'))
+step = 0.5                  # seconds of simulated time between looks at the plant
+# ----------------------------------------------------------------------------------------
+def simulate(policy, profile, args):
+    # one card, one policy, one profile, returns the scores
+    clock = [0.0]
+    gpu_d.time = lambda: clock[0]
+    gpu_d.fan_rule = args.controller
+    gpu_d.target_temp, gpu_d.tolerance = args.target, args.tolerance
+    gpu_d.throttle_mode = 'boinc' if policy == 'boinc' else None
+    gpu_d.throttle_period = args.period
+    gpu_d.ThermalPlant.ambient = args.ambient
+    sim = gpu_d.SimBackend([profile])
+    plant = sim.plants[0]
+    suspends = [0]
+
+    def boinc_gpu_mode(mode, seconds=0):
+        plant.advance(clock[0])
+        if mode == 'never':
+            plant.suspend(seconds or float('inf'))
+            suspends[0] += 1
+        else:
+            plant.suspended_until = float('-inf')
+    gpu_d.boinc_gpu_mode = boinc_gpu_mode
+    gpu_d.backend = gpu_d.CachedBackend(sim)
+    c = gpu_d.make_controllers([0], None)[0]
+    gpu_d.controllers = [c]
+    c.start()
+    next_tick = next_throttle = 0
+    asked = done = over = loaded = temp_sum = hottest = 0
+    suspended = False
+    while clock[0] < args.duration:
+        if clock[0] >= next_tick:
+            c.tick()
+            next_tick = c.tick_started + c.period
+            if policy == 'suspend':
+                temp = c.sample['temp']
+                if not suspended and temp > c.target + c.tolerance and c.current_speed >= c.fan_high:
+                    boinc_gpu_mode('never')
+                    suspended = True
+                elif suspended and temp < c.target - c.tolerance:
+                    boinc_gpu_mode('auto')
+                    suspended = False
+        if policy == 'boinc' and clock[0] >= next_throttle:
+            gpu_d.apply_throttle()
+            next_throttle += args.period
+        plant.advance(clock[0])
+        wanted = gpu_d.load_profiles[profile](clock[0])
+        temp = int(round(plant.die))
+        asked += wanted * step
+        done += plant.util() * step
+        over += step if temp > args.target + args.tolerance else 0
+        if wanted:
+            loaded += step
+            temp_sum += temp * step
+        hottest = max(hottest, temp)
+        clock[0] += step
+    return {'work_pct': round(100 * done / asked, 1) if asked else 100,
+            'measured_pct': round(100 * 100 * c.work / asked, 1) if asked else 100,
+            'mean_c': round(temp_sum / loaded, 1) if loaded else None,
+            'over_band_s': over,
+            'max_c': hottest,
+            'suspends': suspends[0]}
+# ----------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='compare suspend/resume with gpu_d --throttle on a simulated card')
+    parser.add_argument('--policies', default='none,suspend,boinc', help='comma separated: none, suspend, boinc')
+    parser.add_argument('--profiles', default='full,boinc,bursty,job_start', help='load profiles')
+    parser.add_argument('--ambient', type=float, default=40, help='air temperature, C')
+    parser.add_argument('--target', type=int, default=70, help='target temperature')
+    parser.add_argument('--tolerance', type=int, default=1, help='tolerance, C')
+    parser.add_argument('--controller', default='pid', help='--controller spec')
+    parser.add_argument('--period', type=float, default=gpu_d.throttle_period, help='--throttle-period')
+    parser.add_argument('--duration', type=float, default=3600, help='simulated seconds per run')
+    parser.add_argument('--output', help='also write the scores as JSON here')
+    args = parser.parse_args()
+
+    results = []
+    columns = ('work_pct', 'measured_pct', 'mean_c', 'over_band_s', 'max_c', 'suspends')
+    print('%-10s %-10s' % ('policy', 'profile') + ''.join('%14s' % k for k in columns))
+    for policy in args.policies.split(','):
+        for profile in args.profiles.split(','):
+            result = simulate(policy, profile, args)
+            print('%-10s %-10s' % (policy, profile) + ''.join('%14s' % result[k] for k in columns))
+            results.append(dict(result, policy=policy, profile=profile))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'ambient': args.ambient, 'target': args.target, 'tolerance': args.tolerance,
+                       'controller': args.controller, 'period': args.period, 'duration': args.duration,
+                       'results': results}, f, indent=2, sort_keys=True)
+# ----------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
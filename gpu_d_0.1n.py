@@ -24,29 +24,61 @@ to do:
             1)  Discover how to unlock the GPU clocks. Being able to reduce clock speed would make it
                 possible to stay close to the target temperature while keeping the fan speed below a
                 user specified limit.
+                (partly done, see --throttle: the load is cut instead, by duty-cycling BOINC or
+                through a power limit where the backend has one)
             2)  An optional audio warning if temperature exceeds target for prolonged period
             3)  An auto-suspend-GPU crunching function if temperature remains above target while actual fan speed (RPM)
                 remains ridiculously low for prolonged period which would indicate failed or failing fan
+                (done, see --on-fan-failure)
             4)  A quiet mode option that produces no screen output to reduce overhead, suitable for running in background
+                (done, see --daemon)
             5)  I'm not sure but the nvidia-settings binary args syntax suggests it _might_ have the ability to get/set
                 params on remote cards. That would be awesome. If that ability doesn't exist then consider implementing an
                 RPC interface similar to BOINC's, quite doable with Python thoughy I'm not sure how robust it would be.  
+                (done, see --server and --fleet)
               
 '''
 
 from __future__ import division
-from time import sleep
-from subprocess import check_output
-from sys import argv
-from os import system
-from os.path import exists
+from time import time
+from subprocess import check_output, CalledProcessError
+from sys import argv, stdout, stdin, exc_info
+from os import system, listdir
+import os
+from os.path import exists, join, getsize
+import ctypes
+import httplib
+import locale
+import mmap
+import struct
+from array import array
+import bisect
+import errno
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import re
+import select
+import signal
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from urlparse import parse_qs
 import curses
 from curses import panel
 
 # #######################  an incomplete list of constants we will use   ################################
-global snooze, fan_speed_up_lim, fan_speed_low_lim, tolerance, nap_msec, stdscr, title
+global snooze, min_period, max_period, fan_speed_up_lim, fan_speed_low_lim, tolerance, nap_msec, stdscr, title
 global x_pix, y_pix, p2_cols, p2_rows
-snooze = 5                  # units = seconds, main loop delay,   
+snooze = 5                  # units = seconds, the control period a card starts with, after that
+                            # AdaptiveScheduler stretches or shrinks it between these two limits:
+min_period = 2              # period while the temperature or the load is moving
+max_period = 30             # ceiling the period backs off to while readings are stable, can't be
+                            # set above AdaptiveScheduler.safety_period
 
                             # All fan speed assignments are percents in range 1 to 100.  
                             # Values outside that range result in nvidia-settings returning
@@ -79,21 +111,87 @@ y_loc = '1'               # default vertical coordinate of upper left corner of
 
 p2_cols = 52                # text columns in curses panel p2
 
-p2_rows = 18                # text rows in curses panel p2
+p2_rows = 20                # text rows in curses panel p2
+
+spark_chars = '_.,:-=+*#'   # sparkline bars, lowest first, replaced by block characters when
+                            # the terminal speaks UTF-8
+
+history_len = 4096          # readings of each card kept in memory for the sparklines etc.
+
+frame_rate = 2              # screen updates per second at most, can specify with --fps
+
+window_check = 5            # seconds between checks whether our X window is minimized
+
+window_hidden = False       # True while it is, redraws are paused
 
 # #######################  list of global vars, probably incomplete too ###############################
 
-global target_temp, current_speed, previous_temp, temp_delta
+global target_temp, controllers
+
+target_temp = 0             # The temperature use wants to maintain, specified on command line,
+                            # can be overridden per GPU with --gpu
+
+controllers = []            # One GpuController per card, each holds that card's fan speed, its
+                            # previous temperature and temp_delta
+
+global backend, record_file
+
+backend = None              # where readings come from and fan speeds go, see make_backend(),
+                            # selected with --backend on the command line
+
+record_file = None          # open trace file if --record was given on the command line
+
+record_lock = threading.Lock()
+
+history_log = None          # HistoryLog if --history-log was given on the command line
+
+log = logging.getLogger('gpu_d')
+log.addHandler(logging.NullHandler())
+
+server_address = None       # (host, port) of the telemetry server if --server was given
+
+fleet_period = 2            # seconds between polls of each host in --fleet mode
+
+show_stats = False          # True with --stats, latency percentiles on the bottom line of the screen
+
+metrics_file = None         # path --metrics-file writes the Prometheus metrics to
+
+metrics_period = 10         # seconds between rewrites of the metrics file
+
+overrun_slack = 0.5         # seconds a tick may start late before it counts as an overrun
+
+fan_rule = 'step'           # how fan speeds are chosen, see make_rule(), can specify with --controller
 
-target_temp = 0             # The temperature use wants to maintain, specified on command line
+fault_actions = ['alarm']   # what to do when a fan looks dead, see fan_failure(), can specify
+                            # with --on-fan-failure
 
-current_speed = 0           # Current fan speed
+fan_confirm = 60            # seconds a fan must look dead before fan_failure() is called
 
-previous_temp = 0           # The GPU temperature read in the previous iteration of the while loop
+boinccmd = 'boinccmd'       # BOINC's command line client, --on-fan-failure=boinc suspends GPU work with it
 
-temp_delta = 0              # The difference between the current GPU temp and the previous temp
+throttle_mode = None        # how a card's load is cut when its fan can't keep it at target, see
+                            # apply_throttle(), None (off), boinc, power or hook:cmd, --throttle
 
-rpm = '0'                   # Fan rpm 
+throttle_period = 60        # seconds between apply_throttle() runs, the length of a BOINC duty cycle
+
+duty_step = 0.05            # change in a card's duty that's worth a power limit write or a hook run
+
+launched = time()           # when the script started, for the time to the first control tick
+
+first_tick = None           # seconds from launched to the end of the first control tick
+
+manifest_dir = join(os.environ.get('XDG_CACHE_HOME') or join(os.path.expanduser('~'), '.cache'), 'gpu_d')
+                            # where the capability manifest is kept between runs, see load_manifest()
+
+manifest_version = 2        # bumped when what a manifest holds changes, older ones are ignored
+
+unsupported_attrs = set()   # (target, attribute) pairs nvidia-settings can't read, see query_batch()
+
+attr_failures = {}          # (target, attribute) -> times it failed on its own while others answered
+
+always_queried = ('GPUCoreTemp',)  # never left out, a card must not lose its temperature
+
+manifest_pending = None     # (--backend, driver version, cards) while the manifest is still to be written
  
 # #########################################################################################
 # ----------------------------------------------------------------------------------------
@@ -140,43 +238,30 @@ def put_text(win, row, col, text, clr):
     win.addstr(text)
     if clr: win.clrtoeol()
 # ----------------------------------------------------------------------------------------
-def monitor(win):
-    global stdscr, nap_msec, target_temp, current_speed, previous_temp, temp_delta, rpm
-    stdscr = win
-    nap_msec = 1
-    stdscr.nodelay(1)
-    stdscr.refresh()
-
-    '''p1 = mkpanel(curses.COLOR_RED, 3, 40, 0, 0)
-    p1.set_userptr('p1')
-    p1.window().move(1, 1)
-    p1.window().addstr(' Dag\'s nVIDIA GPU temperature monitor')
-    p1.window().clrtoeol()
-    #s = " Dag's nVIDIA GPU temperature monitor"
-    #fill_panel(p1, s)
-    p1.window().box() '''
-
-    p2 = mkpanel(curses.COLOR_BLUE, p2_rows, p2_cols, 0, 0)
-    p2.set_userptr('p2')
-    win = p2.window()
-    
-    # print static text in p2 (panel 2), this text never changes so we print it onc here outside the main 
-    # work loop, text that changes periodically is of course printed inside the main loop below
+def link_speed(mts):
+    # PCIe lane speed in MT/s as printed in the panel
+    if mts is None: return 'None'
+    return str(round(mts / 1000, 2)) + ' GT/s'
+# ----------------------------------------------------------------------------------------
+def draw_static(win, c):
+    # print the static text in a card's panel, this text never changes so we print it once
+    # outside the main work loop, text that changes periodically is printed by draw_panel()
+    info = c.info
     col1 = 1
     put_text(win, 1, col1, 'Utilization (%)     PCIe', True)
-    put_text(win, 2, col1, '   cpu:                generation:       ' + get_nvidia_info('PCIEGen'), True)
-    put_text(win, 3, col1, '   graphics:           max. link width:  ' + get_nvidia_info('PCIEMaxLinkWidth'), True)
-    put_text(win, 4, col1, '   memory:             curr. link width: ' + get_nvidia_info('PCIECurrentLinkWidth'), True)
-    put_text(win, 5, col1, '   video:              max. link speed:  ' + str(round(int(get_nvidia_info('PCIEMaxLinkSpeed')) / 1000, 2)) + ' GT/s', True)
-    put_text(win, 6, col1, '   PCIe:               curr. link speed: ' + str(round(int(get_nvidia_info('PCIECurrentLinkSpeed')) / 1000, 2)) + ' GT/s', True)
+    put_text(win, 2, col1, '   cpu:                generation:       ' + str(info['pcie_gen']), True)
+    put_text(win, 3, col1, '   graphics:           max. link width:  ' + str(info['pcie_max_width']), True)
+    put_text(win, 4, col1, '   memory:             curr. link width: ' + str(info['pcie_cur_width']), True)
+    put_text(win, 5, col1, '   video:              max. link speed:  ' + link_speed(info['pcie_max_speed']), True)
+    put_text(win, 6, col1, '   PCIe:               curr. link speed: ', True)     # see draw_panel()
     put_text(win, 7, col1, 'Temperature (C)     Clocks', True)
     put_text(win, 8, col1, '   target:             graphics:', True)
     put_text(win, 9, col1, '   current:            memory:', True)
     put_text(win, 10, col1, '   delta:           Ram', True)
-    put_text(win, 11, col1, 'Fan speed              total:     ' + get_gpu_info('TotalDedicatedGPUMemory'), True)
+    put_text(win, 11, col1, 'Fan speed              total:     ' + str(info['mem_total']), True)
     put_text(win, 12, col1, '   current:            used:' , True)
-    put_text(win, 13, col1, '   delta:           CUDA cores:   ' + get_gpu_info('CUDACores'), True)
-    put_text(win, 14, col1, '   rpm:             Driver:       ' + get_nvidia_info('NvidiaDriverVersion'), False)
+    put_text(win, 13, col1, '   delta:           CUDA cores:   ' + str(info['cuda_cores']), True)
+    put_text(win, 14, col1, '   rpm:             Driver:       ' + str(info['driver']), False)
     put_text(win, 15, col1, ' ', True)
 
     '''col1 = 22
@@ -194,135 +279,2193 @@ def monitor(win):
     put_text(win, 12, col2, '    current %:')
     put_text(win, 13, col2, '    delta %:')
     put_text(win, 14, col2, '    rpm:')'''
+    draw_box(win, c)
+# ----------------------------------------------------------------------------------------
+def draw_box(win, c):
     win.box()
+    win.addstr(0, 2, ' GPU ' + str(c.gpu) + ' ')
+# ----------------------------------------------------------------------------------------
+class PanelView(object):
+    # View model of a card's panel. It remembers the text last put at each (row, col) and only
+    # writes a cell to the window when its text changed, padding with spaces to wipe what's
+    # left of a longer old value. Nothing reaches the terminal until the frame timer in
+    # monitor() calls pflush(), and then only if some panel is dirty.
+
+    def __init__(self, win):
+        self.win = win
+        self.cells = {}
+        self.dirty = False
+
+    def put(self, row, col, text):
+        old = self.cells.get((row, col))
+        if text == old: return
+        padded = text.ljust(len(old)) if old else text
+        if isinstance(padded, unicode): padded = padded.encode('utf-8')
+        self.win.addstr(row, col, padded)
+        self.cells[(row, col)] = text
+        self.dirty = True
+# ----------------------------------------------------------------------------------------
+def draw_panel(view, c):
+    sample = c.sample
+    util = sample['util'] or dict.fromkeys(util_keys)
+    col1, col2 = 14, 35
+    view.put(2, col1, '99')
+    view.put(3, col1, str(util['graphics']))
+    view.put(4, col1, str(util['memory']))
+    view.put(5, col1, str(util['video']))
+    view.put(6, col1, str(util['PCIe']))
+    view.put(8, col1, str(c.target))
+    view.put(9, col1, str(sample['temp']))
+    view.put(10, col1, str(c.temp_delta))
+    view.put(12, col1, str(c.current_speed))
+    view.put(13, col1, str(c.speed_delta))
+    view.put(14, col1, str(sample['rpm']))
+
+    view.put(8, col2, str(sample['gfx_clock']))
+    view.put(9, col2, str(sample['mem_clock']))
+    view.put(12, col2, str(sample['mem_used']))
+    view.put(6, 41, link_speed(c.info['pcie_cur_speed']))
+    # GPUCurrentClockFreqsString
+    
+    #put_text(win, 13, col2, get_gpu_info('CUDACores'), False)
+    stats = backend.stats(c.gpu)
+    view.put(15, 1, 'cache hit/miss ' + str(stats['hits']) + '/' + str(stats['misses']) +
+             ' fan skips ' + str(stats['writes_skipped']))
+    for row, label, name, unit in ((16, 'temp ', 'temp', 'C'), (17, 'fan  ', 'fan', '%')):
+        line, (lo, hi) = sparkline(c.history.last(name, 34), 34)
+        view.put(row, 1, label + line + ' ' + str(lo) + '-' + str(hi) + unit)
+    view.put(18, 1, 'FAN FAILURE? check the fan' if c.fan_check.tripped else 'Press q to exit')
+    if throttle_mode:
+        view.put(18, 32, 'duty ' + str(int(round(c.duty * 100))) + '%')
+# ----------------------------------------------------------------------------------------
+def terminal_visible():
+    # False while we're a background job on the terminal or, when we know our X window
+    # ($WINDOWID), while it's minimized, see check_window_state()
+    try:
+        if os.tcgetpgrp(stdin.fileno()) != os.getpgrp(): return False
+    except OSError:
+        pass
+    return not window_hidden
+# ----------------------------------------------------------------------------------------
+def check_window_state():
+    # runs on the pool every window_check seconds, asks the window manager whether our
+    # terminal window is minimized
+    global window_hidden
+    try:
+        state = check_output(['xprop', '-id', os.environ['WINDOWID'], '_NET_WM_STATE'])
+    except (CalledProcessError, OSError):
+        return
+    window_hidden = '_NET_WM_STATE_HIDDEN' in state
+# ----------------------------------------------------------------------------------------
+def monitor(win):
+    global stdscr, nap_msec
+    stdscr = win
+    nap_msec = 1
+    stdscr.nodelay(1)
+    stdscr.refresh()
 
-    #pflush()
+    '''p1 = mkpanel(curses.COLOR_RED, 3, 40, 0, 0)
+    p1.set_userptr('p1')
+    p1.window().move(1, 1)
+    p1.window().addstr(' Dag\'s nVIDIA GPU temperature monitor')
+    p1.window().clrtoeol()
+    #s = " Dag's nVIDIA GPU temperature monitor"
+    #fill_panel(p1, s)
+    p1.window().box() '''
 
+    # one panel per card, tiled left to right then top to bottom. Cards that don't fit in the
+    # terminal are still controlled, they just aren't shown.
+    across = max(1, curses.COLS // p2_cols)
+    lines = curses.LINES - 1 if show_stats else curses.LINES     # bottom line left for --stats
+    views = {}
+    for i, c in enumerate(controllers):
+        tly, tlx = (i // across) * p2_rows, (i % across) * p2_cols
+        if tly + p2_rows > lines:
+            saywhat(str(len(controllers) - i) + ' GPU(s) not shown, enlarge the window')
+            break
+        p = mkpanel(curses.COLOR_BLUE, p2_rows, p2_cols, tly, tlx)
+        p.set_userptr('gpu' + str(c.gpu))
+        views[c.gpu] = PanelView(p.window())
+        draw_static(p.window(), c)
+    pflush()
 
-    # The main work loop, iterates until user presses q at which time the script exits.
+    # The main work loop, runs until user presses q at which time the script exits.
     # At this time user input other than q is ignored.
-                
-    # The way it works is simple. We read the current temp, if it's not between acceptable
-    # limits (the target temp specified on the command line +/- 1) we take corrective action
-    # unless the temp_delta indicates the temperature is already going in the desired direction.
-    # Without tracking and using temp_delta the NTSNWB (not too sophisticated, never will be)
-    # algorithm tends to over-correct which can produce wild and unnecessary swings in fan speed
-    # due to temperature<->(cooling effect) hysteresis I guess. 
-
-    while 1:
-        x = get_utilization().split(',')
-        current_temp = get_temp()
-        temp_delta = current_temp - previous_temp
-        new_speed = current_speed
-            
-        if current_temp > target_temp + tolerance:
-            if temp_delta > -1:
+    # Every card is sampled and controlled (GpuController.tick()) on the loop's pool as its own
+    # task, when a card's next tick is due is up to its AdaptiveScheduler. Keys are read as
+    # soon as they arrive on stdin. A finished tick only updates its PanelView, the screen is
+    # flushed frame_rate times a second if anything changed and the terminal can be seen.
+    loop = EventLoop(len(controllers) + 1)
+    stats_view = PanelView(stdscr)
+
+    def on_key():
+        while 1:
+            key = stdscr.getch()
+            if key == -1: break
+            if key == ord('q'): loop.stop()
+
+    def on_ticked(c):
+        if c.gpu in views:
+            with metrics.timed('phase', 'render'):
+                draw_panel(views[c.gpu], c)
+
+    def frame():
+        loop.call_later(1 / frame_rate, frame)
+        if show_stats:
+            overruns = sum(c.overruns for c in controllers)
+            stats_view.put(curses.LINES - 1, 0, (metrics.summary(('tick', 'sample', 'fan_write', 'render')) +
+                                                 '  overruns ' + str(overruns))[:curses.COLS - 1])
+        dirty = [v for v in views.values() + [stats_view] if v.dirty]
+        if dirty and terminal_visible():
+            with metrics.timed('phase', 'flush'):
+                if stats_view.dirty: stdscr.noutrefresh()
+                pflush()
+            for v in dirty: v.dirty = False
+
+    def check_window():
+        loop.call_later(window_check, check_window)
+        loop.run_in_pool(check_window_state, lambda result: None)
+
+    loop.add_reader(stdin.fileno(), on_key)
+    start_services(loop)
+    for c in controllers:
+        schedule_tick(loop, c, on_ticked)
+    frame()
+    if 'WINDOWID' in os.environ and exists('/usr/bin/xprop'):
+        check_window()
+    loop.run()
+    loop.close()
+    if metrics_file: write_metrics_file()
+    return()
+# ----------------------------------------------------------------------------------------
+def run_daemon():
+    # The control loop without any screen output, for running under systemd and the like. Each
+    # card is ticked when its AdaptiveScheduler says, in between the process sleeps in select()
+    # so it uses next to no CPU. A signal wakes it: SIGTERM and SIGINT wait for ticks in
+    # progress then restore automatic fan control through restore_fans(), SIGUSR1 ticks every card
+    # straight away. Logs go to stdout which systemd passes on to the journal.
+    loop = EventLoop(len(controllers) + 1)      # a spare worker for apply_throttle()
+
+    def on_exit(signum, frame):
+        log.info('signal %d, restoring automatic fan control', signum)
+        loop.call_soon_threadsafe(loop.stop)
+
+    def on_wake(signum, frame):
+        loop.call_soon_threadsafe(wake)
+
+    def wake():
+        log_stats()
+        for c in controllers:
+            tick_now(loop, c, ticked)
+
+    def log_stats():
+        for c in controllers:
+            stats = backend.stats(c.gpu)
+            log.info('GPU %d cache: %d hits, %d misses, %d fan writes, %d skipped, %d overruns', c.gpu,
+                     stats['hits'], stats['misses'], stats['writes'], stats['writes_skipped'], c.overruns)
+            log.info('GPU %d work: %.0f busy seconds, duty %d%%', c.gpu, c.work, round(c.duty * 100))
+        log.info('%s', metrics.summary(('tick', 'sample', 'control', 'fan_write')))
+
+    def ticked(c):
+        log.debug('GPU %d: %s C (delta %d), fan %d%% (delta %d), %s rpm, next in %gs', c.gpu,
+                  c.sample['temp'], c.temp_delta, c.current_speed, c.speed_delta, c.sample['rpm'], c.period)
+        if c.speed_delta:
+            log.info('GPU %d: %s C, target %d, fan %d%%', c.gpu, c.sample['temp'], c.target, c.current_speed)
+
+    signal.signal(signal.SIGTERM, on_exit)
+    signal.signal(signal.SIGINT, on_exit)
+    signal.signal(signal.SIGUSR1, on_wake)
+
+    log.info('controlling %d GPU(s) with the %s backend', len(controllers), backend.name)
+    start_services(loop)
+    for c in controllers:
+        schedule_tick(loop, c, ticked)
+    try:
+        loop.run()
+    finally:
+        loop.close()
+        restore_fans()          # whatever stopped the loop
+    log_stats()
+    if metrics_file: write_metrics_file()
+    exit(2 if any(c.fault_exit for c in controllers) else 0)
+# ----------------------------------------------------------------------------------------
+class EventLoop(object):
+    # A small select() based event loop, what asyncio would give us on Python 3. It has
+    # timers, file descriptor readers and writers and blocking calls (backend reads and writes) run on a
+    # thread pool with the result handed back to the loop thread. Other threads and signal
+    # handlers hand work to the loop with call_soon_threadsafe(), which also wakes it through a
+    # pipe. Everything that touches curses or tick scheduling runs on the loop thread, nothing
+    # on it blocks, so a keypress is seen as soon as it arrives.
+
+    def __init__(self, workers):
+        self.pool = ThreadPool(workers)
+        self.timers = []            # heap of [when, sequence, callback, args]
+        self.sequence = itertools.count()
+        self.readers = {}           # fd -> callback
+        self.writers = {}
+        self.ready = deque()        # (callback, args) to run on the next pass
+        self.running = False
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def call_at(self, when, callback, *args):
+        timer = [when, next(self.sequence), callback, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.ready.append((callback, args))
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError:
+            pass                    # pipe full, the loop has plenty of wake-ups pending
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def run_in_pool(self, func, callback):
+        # func() runs on the pool, callback(result) on the loop thread. An exception raised
+        # by func is re-raised on the loop thread.
+        def work():
+            try:
+                result = (True, func())
+            except Exception:
+                result = (False, exc_info())
+            self.call_soon_threadsafe(self.finished, callback, result)
+        self.pool.apply_async(work)
+
+    def finished(self, callback, result):
+        ok, value = result
+        if not ok:
+            raise value[0], value[1], value[2]
+        callback(value)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = None
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time())
+            try:
+                readable, writable = select.select([self.wake_r] + self.readers.keys(),
+                                                   self.writers.keys(), [], timeout)[:2]
+            except select.error as e:
+                if e.args[0] != errno.EINTR: raise
+                readable = writable = []    # a signal, its handler queued whatever it wants done
+            for fd in readable:
+                if fd == self.wake_r:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except OSError:
+                        pass
+                elif fd in self.readers:
+                    self.readers[fd]()
+            for fd in writable:
+                if fd in self.writers:
+                    self.writers[fd]()
+            now = time()
+            while self.timers and self.timers[0][0] <= now:
+                timer = heapq.heappop(self.timers)
+                if timer[2]: timer[2](*timer[3])
+            while self.ready and self.running:
+                callback, args = self.ready.popleft()
+                callback(*args)
+
+    def close(self):
+        # waits for work still running on the pool, e.g. a tick half way through a fan write
+        self.pool.close()
+        self.pool.join()
+# ----------------------------------------------------------------------------------------
+def schedule_tick(loop, c, on_ticked, when=0):
+    # The control step of a card as its own task: run c.tick() on the pool, pass the card to
+    # on_ticked() on the loop thread and schedule the next tick when the card's scheduler says.
+    c.due = when
+    c.timer = loop.call_at(when, run_tick, loop, c, on_ticked)
+# ----------------------------------------------------------------------------------------
+def run_tick(loop, c, on_ticked):
+    c.timer = None
+    loop.run_in_pool(lambda: guarded_tick(c), lambda ok: tick_done(loop, c, on_ticked, ok))
+# ----------------------------------------------------------------------------------------
+def guarded_tick(c):
+    # c.tick() on the pool. An error is logged and the card's fan set to fan_high if the card
+    # still takes it, then the card is tried again after min_period. One bad card doesn't stop
+    # the control of the others. Returns False if the tick failed.
+    try:
+        c.tick()
+        return True
+    except Exception:
+        log.exception('GPU %d: tick failed', c.gpu)
+    c.period = c.scheduler.period = c.scheduler.min_period
+    try:
+        c.current_speed = backend.set_fan(c.gpu, c.fan_high)
+    except Exception as e:
+        log.error('GPU %d: cannot set the fan to %d%%: %s', c.gpu, c.fan_high, e)
+    return False
+# ----------------------------------------------------------------------------------------
+def tick_done(loop, c, on_ticked, ok=True):
+    # A tick overran if the pool got to it more than overrun_slack seconds after it was due or
+    # it finished after its period was up, either way the card wasn't watched as often as
+    # its scheduler asked. Only a tick that worked is passed to on_ticked().
+    global first_tick
+    took = time() - c.tick_started
+    metrics.observe('phase', 'tick', took)
+    if first_tick is None:
+        first_tick = time() - launched
+        log.info('first control tick done %.3fs after start', first_tick)
+    if manifest_pending and all(c.sample for c in controllers):
+        save_manifest(*manifest_pending)        # once every card was read, see query_batch()
+    if (c.due and c.tick_started - c.due > overrun_slack) or took > c.period:
+        c.overruns += 1
+        log.debug('GPU %d: tick overran, %.3fs late, took %.3fs of a %gs period', c.gpu,
+                  max(0, c.tick_started - c.due), took, c.period)
+    if ok: on_ticked(c)
+    if c.fault_exit:
+        log.critical('GPU %d: exiting on fan failure', c.gpu)
+        return loop.stop()
+    schedule_tick(loop, c, on_ticked, c.tick_started + c.period)
+# ----------------------------------------------------------------------------------------
+def tick_now(loop, c, on_ticked):
+    # tick a card straight away unless a tick is already running
+    if c.timer:
+        loop.cancel(c.timer)
+        run_tick(loop, c, on_ticked)
+# ----------------------------------------------------------------------------------------
+class TelemetryServer(object):
+    # The remote get/set interface (to-do item 5), a small HTTP/1.1 JSON server on the event
+    # loop, --server on the command line. Connections are kept alive so an aggregator polling
+    # every few seconds reuses one connection per host. Requests:
+    #   GET  /status                        every card's current readings and settings
+    #   GET  /history?gpu=0&n=300           the last n readings of a card, one list per column
+    #   POST /target  {"gpu": 0, "target": 65}  change a card's target temperature, without
+    #                                       "gpu" every card's
+    #   GET  /metrics                       timings and counters in Prometheus text format
+    # A connection idle for idle_timeout seconds is closed. Out of file descriptors, the server
+    # stops accepting for accept_pause seconds rather than spin on a listening socket that
+    # stays readable.
+    max_request = 65536
+    idle_timeout = 30
+    accept_pause = 1
+
+    def __init__(self, loop, address):
+        self.loop = loop
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+        self.conns = {}             # fd -> [socket, bytes received, bytes to send, close when sent,
+                                    #        time of the last byte either way]
+        loop.add_reader(self.sock.fileno(), self.accept)
+        loop.call_later(self.idle_timeout, self.drop_idle)
+
+    def accept(self):
+        try:
+            sock = self.sock.accept()[0]
+        except socket.error as e:
+            if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                log.warning('telemetry server: %s, not accepting for %gs', e.args[1], self.accept_pause)
+                self.loop.remove_reader(self.sock.fileno())
+                self.loop.call_later(self.accept_pause, self.loop.add_reader, self.sock.fileno(), self.accept)
+            return                  # else the client gave up before we got to it
+        sock.setblocking(0)
+        fd = sock.fileno()
+        self.conns[fd] = [sock, '', '', False, time()]
+        self.loop.add_reader(fd, lambda: self.readable(fd))
+
+    def drop_idle(self):
+        self.loop.call_later(self.idle_timeout, self.drop_idle)
+        now = time()
+        for fd in [fd for fd, conn in self.conns.items() if now - conn[4] > self.idle_timeout]:
+            self.drop(fd)
+
+    def drop(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self.conns.pop(fd)[0].close()
+
+    def readable(self, fd):
+        conn = self.conns[fd]
+        try:
+            data = conn[0].recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            data = ''
+        if not data:
+            return self.drop(fd)
+        conn[1] += data
+        conn[4] = time()
+        while 1:
+            end = conn[1].find('\r\n\r\n')
+            if end < 0 or len(conn[1]) > self.max_request:
+                if len(conn[1]) > self.max_request: self.drop(fd)
+                return
+            lines = conn[1][:end].split('\r\n')
+            headers = dict((k.strip().lower(), v.strip()) for k, _, v in
+                           (line.partition(':') for line in lines[1:]))
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                return self.drop(fd)
+            if len(conn[1]) < end + 4 + length:
+                return              # rest of the body still to come
+            body = conn[1][end + 4:end + 4 + length]
+            conn[1] = conn[1][end + 4 + length:]
+            request = lines[0].split()
+            if len(request) != 3:
+                return self.drop(fd)
+            method, target, version = request
+            status, result = self.handle(method, target, body)
+            if isinstance(result, str):
+                payload, content_type = result, 'text/plain; version=0.0.4'
+            else:
+                payload, content_type = json.dumps(result), 'application/json'
+            keep = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            conn[2] += ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                        'Connection: %s\r\n\r\n' % (status, httplib.responses[status], content_type,
+                                                    len(payload), 'keep-alive' if keep else 'close')) + payload
+            conn[3] = conn[3] or not keep
+            self.loop.add_writer(fd, lambda: self.writable(fd))
+
+    def writable(self, fd):
+        conn = self.conns[fd]
+        try:
+            sent = conn[0].send(conn[2])
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            return self.drop(fd)
+        conn[2] = conn[2][sent:]
+        conn[4] = time()
+        if not conn[2]:
+            self.loop.remove_writer(fd)
+            if conn[3]: self.drop(fd)
+
+    def handle(self, method, target, body):
+        # returns (HTTP status, object to send as JSON or a str to send as plain text)
+        path, _, query = target.partition('?')
+        query = dict((k, v[-1]) for k, v in parse_qs(query).items())
+        cards = dict((c.gpu, c) for c in controllers)
+        try:
+            if path == '/status' and method == 'GET':
+                return 200, status_report()
+            elif path == '/metrics' and method == 'GET':
+                return 200, prometheus_report()
+            elif path == '/history' and method == 'GET':
+                c = cards[int(query.get('gpu', 0))]
+                n = min(int(query.get('n', 300)), history_len)
+                if n < 1:
+                    return 400, {'error': 'n must be at least 1'}
+                return 200, {'gpu': c.gpu, 'columns': dict((name, c.history.last(name, n))
+                                                           for name, code in History.columns)}
+            elif path == '/target' and method == 'POST':
+                request = json.loads(body)
+                target = int(request['target'])
+                if not 0 < target <= 85:
+                    return 400, {'error': 'target must be between 1 and 85'}
+                changed = [cards[int(request['gpu'])]] if 'gpu' in request else controllers
+                for c in changed:
+                    log.info('GPU %d: target changed from %d to %d remotely', c.gpu, c.target, target)
+                    c.target = target
+                return 200, status_report()
+            elif path in ('/status', '/history', '/target', '/metrics'):
+                return 405, {'error': 'method not allowed'}
+            return 404, {'error': 'no such resource'}
+        except KeyError as e:
+            return 404 if path == '/history' else 400, {'error': 'bad request, ' + str(e)}
+        except (ValueError, TypeError) as e:
+            return 400, {'error': 'bad request, ' + str(e)}
+# ----------------------------------------------------------------------------------------
+def status_report():
+    # what GET /status returns
+    gpus = []
+    for c in controllers:
+        report = dict(c.sample or {})
+        report.update({'gpu': c.gpu, 'target': c.target, 'tolerance': c.tolerance,
+                       'fan': c.current_speed, 'temp_delta': c.temp_delta, 'period': c.period,
+                       'fan_low': c.fan_low, 'fan_high': c.fan_high, 'fan_fault': c.fan_check.tripped,
+                       'duty': c.duty, 'work': c.work})
+        gpus.append(report)
+    return {'host': socket.gethostname(), 'backend': backend.name, 'time': time(), 'gpus': gpus}
+# ----------------------------------------------------------------------------------------
+def prometheus_report():
+    # what GET /metrics returns and --metrics-file writes: the Metrics histograms, every card's
+    # overruns and cache counters, its current readings and which driver it runs
+    lines = metrics.prometheus()
+    counters = (('gpu_d_tick_overruns_total', 'ticks that started late or outlasted their period',
+                 lambda c: c.overruns),
+                ('gpu_d_cache_hits_total', 'readings served from the cache', lambda c: backend.stats(c.gpu)['hits']),
+                ('gpu_d_cache_misses_total', 'readings fetched from the card', lambda c: backend.stats(c.gpu)['misses']),
+                ('gpu_d_fan_writes_total', 'fan speed writes sent to the card',
+                 lambda c: backend.stats(c.gpu)['writes']),
+                ('gpu_d_fan_writes_skipped_total', 'fan speed writes skipped as unchanged',
+                 lambda c: backend.stats(c.gpu)['writes_skipped']),
+                ('gpu_d_work_seconds_total', 'graphics utilization times time, seconds of full load',
+                 lambda c: round(c.work, 3)))
+    gauges = (('gpu_d_temperature_celsius', 'last temperature reading', lambda c: (c.sample or {}).get('temp')),
+              ('gpu_d_target_celsius', 'target temperature', lambda c: c.target),
+              ('gpu_d_fan_percent', 'fan speed the card accepted last', lambda c: c.current_speed),
+              ('gpu_d_fan_rpm', 'slowest fan of the card', lambda c: (c.sample or {}).get('rpm')),
+              ('gpu_d_period_seconds', 'current control period', lambda c: c.period),
+              ('gpu_d_fan_fault', '1 while the fan looks dead', lambda c: int(c.fan_check.tripped)),
+              ('gpu_d_duty_ratio', 'fraction of the time GPU work may run, see --throttle', lambda c: c.duty))
+    for kind, families in (('counter', counters), ('gauge', gauges)):
+        for metric, text, value in families:
+            lines += ['# HELP ' + metric + ' ' + text, '# TYPE ' + metric + ' ' + kind]
+            for c in controllers:
+                v = value(c)
+                if v is not None: lines.append('%s{gpu="%d"} %s' % (metric, c.gpu, v))
+    if first_tick is not None:
+        lines += ['# HELP gpu_d_first_tick_seconds time from start to the end of the first control tick',
+                  '# TYPE gpu_d_first_tick_seconds gauge', 'gpu_d_first_tick_seconds %.6f' % first_tick]
+    lines += ['# HELP gpu_d_driver_info driver and backend of each card', '# TYPE gpu_d_driver_info gauge']
+    for c in controllers:
+        lines.append('gpu_d_driver_info{gpu="%d",backend="%s",driver="%s"} 1' % (
+            c.gpu, prom_escape(backend.name), prom_escape((c.info or {}).get('driver'))))
+    return '\n'.join(lines) + '\n'
+# ----------------------------------------------------------------------------------------
+def write_metrics_file():
+    # --metrics-file, written whole to a temporary file then renamed over the old one so a
+    # reader (e.g. node_exporter's textfile collector) never sees half of it
+    try:
+        with open(metrics_file + '.tmp', 'w') as f:
+            f.write(prometheus_report())
+        os.rename(metrics_file + '.tmp', metrics_file)
+    except (IOError, OSError) as e:
+        log.warning('cannot write %s: %s', metrics_file, e)
+# ----------------------------------------------------------------------------------------
+def start_services(loop):
+    # network services, the metrics file and the throttle both the screen and the daemon run
+    # on their event loop
+    if server_address:
+        TelemetryServer(loop, server_address)
+        log.info('serving telemetry on %s:%d', *server_address)
+    if metrics_file:
+        def rewrite():
+            loop.call_later(metrics_period, rewrite)
+            write_metrics_file()
+        loop.call_later(metrics_period, rewrite)
+    if throttle_mode:
+        def throttle():
+            loop.call_later(throttle_period, throttle)
+            loop.run_in_pool(apply_throttle, lambda result: None)
+        loop.call_later(throttle_period, throttle)
+# ----------------------------------------------------------------------------------------
+def parse_address(spec, default_host):
+    # [host:]port -> (host, port)
+    host, _, port = spec.rpartition(':')
+    return (host or default_host, int(port))
+# ----------------------------------------------------------------------------------------
+class FleetClient(object):
+    # One host polled by the aggregator. The HTTP connection is kept open between polls and
+    # only remade after an error.
+    timeout = 5
+
+    def __init__(self, spec):
+        self.address = parse_address(spec, 'localhost')
+        self.name = spec
+        self.conn = None
+        self.status = None
+        self.error = 'not polled yet'
+        self.polling = False
+
+    def poll(self):
+        # runs on the pool, returns (status, error)
+        try:
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+            self.conn.request('GET', '/status')
+            response = self.conn.getresponse()
+            status = json.loads(response.read())
+            if response.status != 200:
+                raise ValueError(status.get('error', response.status) if isinstance(status, dict)
+                                 else response.status)
+            if not valid_status(status):
+                raise ValueError('not a gpu_d status')
+            return status, None
+        except (socket.error, httplib.HTTPException, ValueError) as e:
+            if self.conn: self.conn.close()
+            self.conn = None
+            return None, str(e) or e.__class__.__name__
+# ----------------------------------------------------------------------------------------
+def valid_status(status):
+    # whether a GET /status body has what draw_fleet() shows, another server on the port
+    # could answer anything
+    ints = (int, long)
+    return (isinstance(status, dict) and isinstance(status.get('gpus'), list) and
+            all(isinstance(g, dict) and isinstance(g.get('gpu'), ints) and
+                isinstance(g.get('target'), ints) and isinstance(g.get('fan'), ints)
+                for g in status['gpus']))
+# ----------------------------------------------------------------------------------------
+def draw_fleet(view, clients):
+    # one row per card of every host, a row saying what's wrong for hosts that don't answer
+    view.put(0, 0, 'host                  gpu  temp target  fan%   rpm  util  clocks MHz    mem MB')
+    row = 1
+    for client in clients:
+        if client.error:
+            lines = [client.name.ljust(21) + 'unreachable: ' + client.error]
+        else:
+            lines = []
+            for g in client.status['gpus']:
+                util = (g.get('util') or {}).get('graphics')
+                lines.append('%-21s %3d %5s %6d %5d %5s %5s %5s/%-6s %6s' % (
+                    client.name[:21], g['gpu'], g.get('temp'), g['target'], g['fan'], g.get('rpm'),
+                    util, g.get('gfx_clock'), g.get('mem_clock'), g.get('mem_used')))
+        for line in lines:
+            if row >= curses.LINES - 1: return
+            view.put(row, 0, line[:curses.COLS - 1])
+            row += 1
+    for stale in [r for (r, col) in view.cells if r >= row and r < curses.LINES - 1]:
+        view.put(stale, 0, '')
+# ----------------------------------------------------------------------------------------
+def run_fleet(win, hosts):
+    # The aggregator, --fleet on the command line. Polls every host's --server concurrently on
+    # the pool every fleet_period seconds and shows all their cards in one table.
+    global stdscr
+    stdscr = win
+    stdscr.nodelay(1)
+    clients = [FleetClient(h) for h in hosts]
+    view = PanelView(stdscr)
+    loop = EventLoop(len(clients))
+
+    def on_key():
+        while 1:
+            key = stdscr.getch()
+            if key == -1: break
+            if key == ord('q'): loop.stop()
+
+    def poll():
+        loop.call_later(fleet_period, poll)
+        for client in clients:
+            if not client.polling:
+                client.polling = True
+                loop.run_in_pool(client.poll, lambda result, client=client: polled(client, result))
+
+    def polled(client, result):
+        client.polling = False
+        client.status, client.error = result
+        draw_fleet(view, clients)
+
+    def frame():
+        loop.call_later(1 / frame_rate, frame)
+        view.put(curses.LINES - 1, 0, 'Press q to exit')
+        if view.dirty and terminal_visible():
+            stdscr.refresh()
+            view.dirty = False
+
+    loop.add_reader(stdin.fileno(), on_key)
+    poll()
+    frame()
+    loop.run()
+    loop.close()
+# ----------------------------------------------------------------------------------------
+def parse_int(s):
+    # integer attributes come back as e.g. '45' or, from some driver versions, '45.'
+    return int(s.strip().rstrip('.'))
+# ----------------------------------------------------------------------------------------
+def parse_pair(s):
+    # GPUCurrentClockFreqs comes back as 'graphics,memory' e.g. '705,1502'
+    return tuple(int(v) for v in s.strip().split(','))
+# ----------------------------------------------------------------------------------------
+def parse_utilization(s):
+    # GPUUtilization comes back as 'graphics=5, memory=2, video=0, PCIe=0'
+    util = {}
+    for item in s.strip().split(','):
+        key, value = item.split('=')
+        util[key.strip()] = int(value)
+    return util
+# ----------------------------------------------------------------------------------------
+# converts the -t output of an attribute to a value, attributes not listed here are returned
+# as stripped strings
+attr_parsers = {
+    'GPUCoreTemp': parse_int,
+    'GPUCurrentFanSpeedRPM': parse_int,
+    'GPUCurrentFanSpeed': parse_int,
+    'GPUCurrentClockFreqs': parse_pair,
+    'GPUUtilization': parse_utilization,
+    'UsedDedicatedGPUMemory': parse_int,
+    'TotalDedicatedGPUMemory': parse_int,
+    'CUDACores': parse_int,
+    'PCIEGen': parse_int,
+    'PCIEMaxLinkWidth': parse_int,
+    'PCIECurrentLinkWidth': parse_int,
+    'PCIEMaxLinkSpeed': parse_int,
+    'PCIECurrentLinkSpeed': parse_int,
+    'GPUFanControlState': parse_int,
+}
+# ----------------------------------------------------------------------------------------
+def query_batch(pairs):
+    # Query several attributes with a single nvidia-settings process instead of one process
+    # per attribute. pairs is a list of (target, attribute) tuples, the result is a dict keyed
+    # on those same tuples holding values converted by the parser in attr_parsers (attributes
+    # without a parser are returned as stripped strings).
+    # With -t nvidia-settings prints exactly one line per query, in the order given.
+    args = ['nvidia-settings']
+    for target, attr in pairs:
+        args += ['--query', target + '/' + attr]
+    attrs = []
+    for target, attr in pairs:
+        if attr not in attrs: attrs.append(attr)
+    try:
+        with metrics.timed('nvidia-settings', ','.join(attrs)):
+            lines = check_output(args + ['-t']).splitlines()
+    except CalledProcessError:
+        lines = []
+    if len(lines) != len(pairs):
+        # An attribute this card/driver doesn't support prints nothing, which shifts every
+        # value after it. Fall back to one query per attribute, unsupported ones give None.
+        # An attribute of a target that fails on its own while others answer, twice, is one
+        # that card/driver doesn't have, it's remembered in unsupported_attrs and left out for
+        # that target from then on. Once could be a hiccup. The temperature is never left out.
+        if len(pairs) == 1:
+            return {pairs[0]: None}
+        result = {}
+        for pair in pairs:
+            result.update(query_batch([pair]))
+        if any(v is not None for v in result.values()):
+            for pair, v in result.items():
+                if v is not None or pair[1] in always_queried:
+                    attr_failures.pop(pair, None)
+                else:
+                    attr_failures[pair] = attr_failures.get(pair, 0) + 1
+                    if attr_failures[pair] > 1: unsupported_attrs.add(pair)
+        return result
+    result = {}
+    for (target, attr), line in zip(pairs, lines):
+        result[(target, attr)] = attr_parsers.get(attr, str.strip)(line)
+    return result
+# ----------------------------------------------------------------------------------------
+# ####################################  backends  #########################################
+#
+# Everything the control loop and the screen need from a card goes through a backend so the
+# nvidia-settings subprocess path is just one way of getting at it. read() returns a dict
+# with the keys in sample_keys, info() the static facts in info_keys, or just the keys asked
+# for, a value a backend can't provide is None. Fan speeds are percents, memory is MB, clocks are MHz and link speeds are
+# MT/s per lane, the same units nvidia-settings reports.
+
+sample_keys = ('temp', 'fan', 'rpm', 'gfx_clock', 'mem_clock', 'mem_used', 'util')
+info_keys = ('pcie_gen', 'pcie_max_width', 'pcie_cur_width', 'pcie_max_speed', 'pcie_cur_speed',
+             'mem_total', 'cuda_cores', 'driver')
+live_info_keys = ('pcie_cur_speed',)        # info that can change while running, read by every tick
+util_keys = ('graphics', 'memory', 'video', 'PCIe')
+
+class BackendError(Exception):
+    pass
+# ----------------------------------------------------------------------------------------
+def pick(values, keys):
+    # the entries of values asked for, None for any it doesn't have
+    return dict((k, values.get(k)) for k in keys)
+# ----------------------------------------------------------------------------------------
+class Backend(object):
+    name = None
+
+    def devices(self):
+        # list of gpu numbers this backend can see
+        return [0]
+
+    def read(self, gpu, keys=sample_keys):
+        raise NotImplementedError
+
+    def info(self, gpu, keys=info_keys):
+        raise NotImplementedError
+
+    def set_fan(self, gpu, speed):
+        # returns the fan speed the card accepted
+        raise NotImplementedError
+
+    def set_fan_control(self, gpu, manual):
+        # returns True if the card is now in the requested (manual or auto) fan control mode
+        raise NotImplementedError
+
+    def start(self, gpu, speed):
+        # switch to manual fan control and set the fan speed, returns the speed the card
+        # accepted or None if it refused manual control
+        if not self.set_fan_control(gpu, True):
+            return None
+        return self.set_fan(gpu, speed)
+
+    def set_power_limit(self, gpu, fraction):
+        # cap the card's power at fraction of the way from its lowest allowed limit to its
+        # default one, 1 puts the default back, returns the limit set in W. See --throttle=power.
+        raise BackendError('the ' + str(self.name) + ' backend cannot set power limits')
+
+    def manifest(self):
+        # what devices() found that's worth keeping between runs as JSON, see load_manifest(),
+        # None if this backend finds it cheaply enough not to bother
+        return None
+
+    def restore(self, manifest):
+        # take back what manifest() returned on an earlier run, returns the gpu list devices()
+        # would have
+        raise NotImplementedError
+# ----------------------------------------------------------------------------------------
+class NvidiaSettingsBackend(Backend):
+    # the original subprocess path, one batched nvidia-settings call per read
+    name = 'nvidia-settings'
+
+    def __init__(self, display='localhost:0'):
+        self.display = display
+        self.gpus = []
+        self.fans = {}
+
+    def devices(self):
+        # The gpus and the fans cooling each, from the verbose gpu list where every gpu's entry
+        # lists its fans ("Is cooled by the following fans"). A gpu with no fan listed there is
+        # left to the driver, its fans can't be told from another card's.
+        out = check_output(['nvidia-settings', '-c', self.display, '--query', 'gpus', '--verbose'])
+        fans, gpu = {}, None
+        for kind, n in re.findall(r'\[(gpu|fan):(\d+)\]', out):
+            if kind == 'gpu':
+                gpu = int(n)
+                fans.setdefault(gpu, [])
+            elif gpu is not None and int(n) not in fans[gpu]:
+                fans[gpu].append(int(n))
+        for gpu in sorted(fans):
+            if not fans[gpu]:
+                log.warning('GPU %d: nvidia-settings lists no fan for it, leaving it to the driver', gpu)
+                del fans[gpu]
+        if not fans:
+            raise BackendError('nvidia-settings lists no GPU with a fan on ' + self.display)
+        self.fans = fans
+        self.gpus = sorted(fans)
+        return self.gpus
+
+    def manifest(self):
+        # JSON keys are strings
+        return {'devices': self.gpus, 'unsupported': [list(pair) for pair in sorted(unsupported_attrs)],
+                'fans': dict((str(g), f) for g, f in self.fans.items())}
+
+    def restore(self, manifest):
+        self.gpus = manifest['devices']
+        self.fans = dict((int(g), f) for g, f in manifest['fans'].items())
+        unsupported_attrs.update(tuple(pair) for pair in manifest['unsupported'] if isinstance(pair, list))
+        return self.gpus
+
+    def targets(self, gpu):
+        # (gpu target, [fan targets])
+        return (self.display + '[gpu:%d]' % gpu, [self.display + '[fan:%d]' % f for f in self.fans[gpu]])
+
+    def read(self, gpu, keys=sample_keys):
+        g, fans = self.targets(gpu)
+        queries = {'temp': [(g, 'GPUCoreTemp')], 'fan': [(fans[0], 'GPUCurrentFanSpeed')],
+                   'rpm': [(f, 'GPUCurrentFanSpeedRPM') for f in fans],
+                   'gfx_clock': [(g, 'GPUCurrentClockFreqs')], 'mem_clock': [(g, 'GPUCurrentClockFreqs')],
+                   'mem_used': [(g, 'UsedDedicatedGPUMemory')], 'util': [(g, 'GPUUtilization')]}
+        pairs = []
+        for k in keys:
+            pairs += [q for q in queries[k] if q not in pairs and q not in unsupported_attrs]
+        x = query_batch(pairs) if pairs else {}
+        freqs = x.get((g, 'GPUCurrentClockFreqs')) or (None, None)
+        # with several fans on a card report the slowest, a stalled fan is what matters
+        rpms = [x[q] for q in queries['rpm'] if x.get(q) is not None]
+        values = {'rpm': min(rpms) if rpms else None, 'gfx_clock': freqs[0], 'mem_clock': freqs[1]}
+        for k in ('temp', 'fan', 'mem_used', 'util'):
+            values[k] = x.get(queries[k][0])
+        return pick(values, keys)
+
+    def info(self, gpu, keys=info_keys):
+        g = self.targets(gpu)[0]
+        attrs = dict(zip(info_keys, ('PCIEGen', 'PCIEMaxLinkWidth', 'PCIECurrentLinkWidth', 'PCIEMaxLinkSpeed',
+                                     'PCIECurrentLinkSpeed', 'TotalDedicatedGPUMemory', 'CUDACores',
+                                     'NvidiaDriverVersion')))
+        pairs = [(g, attrs[k]) for k in keys if (g, attrs[k]) not in unsupported_attrs]
+        x = query_batch(pairs) if pairs else {}
+        return dict((k, x.get((g, attrs[k]))) for k in keys)
+
+    def set_fan(self, gpu, speed):
+        # all the card's fans in one call, the first line of output is the first fan's
+        args = ['nvidia-settings']
+        for f in self.targets(gpu)[1]:
+            args += ['--assign', f + '/GPUCurrentFanSpeed=' + str(speed)]
+        x = check_output(args + ['-t']).strip().splitlines()[0]
+        return (int(x[x.rfind(' ') + 1:x.rfind('.')]))
+
+    def set_fan_control(self, gpu, manual):
+        g = self.targets(gpu)[0]
+        state = int(bool(manual))
+        check_output(['nvidia-settings', '--assign', g + '/GPUFanControlState=' + str(state)])
+        return query_batch([(g, 'GPUFanControlState')])[(g, 'GPUFanControlState')] == state
+
+    def start(self, gpu, speed):
+        # manual control, every fan's speed and the check manual control took, all in one call.
+        # The last line is the queried state, the fan speed the card accepted is on the first
+        # fan's assign line.
+        g, fans = self.targets(gpu)
+        args = ['nvidia-settings', '--assign', g + '/GPUFanControlState=1']
+        for f in fans:
+            args += ['--assign', f + '/GPUCurrentFanSpeed=' + str(speed)]
+        lines = check_output(args + ['--query', g + '/GPUFanControlState', '-t']).strip().splitlines()
+        try:
+            if not lines or parse_int(lines[-1]) != 1:
+                return None
+        except ValueError:
+            return None
+        accepted = [x for x in lines if 'GPUCurrentFanSpeed' in x]
+        if accepted:
+            x = accepted[0]
+            return (int(x[x.rfind(' ') + 1:x.rfind('.')]))
+        return speed
+# ----------------------------------------------------------------------------------------
+class NvmlBackend(Backend):
+    # In-process reads through libnvidia-ml with ctypes, no fork/exec per reading. Functions
+    # missing from older libraries (fan set/restore, core count) report None or fail softly.
+    name = 'nvml'
+    NVML_SUCCESS = 0
+    NVML_TEMPERATURE_GPU = 0
+    NVML_CLOCK_GRAPHICS, NVML_CLOCK_MEM = 0, 2
+    lane_speeds = {1: 2500, 2: 5000, 3: 8000, 4: 16000, 5: 32000, 6: 64000}
+
+    class Memory(ctypes.Structure):
+        _fields_ = [('total', ctypes.c_ulonglong), ('free', ctypes.c_ulonglong), ('used', ctypes.c_ulonglong)]
+
+    class Utilization(ctypes.Structure):
+        _fields_ = [('gpu', ctypes.c_uint), ('memory', ctypes.c_uint)]
+
+    def __init__(self, lib='libnvidia-ml.so.1'):
+        try:
+            self.lib = ctypes.CDLL(lib)
+        except OSError as e:
+            raise BackendError('cannot load ' + lib + ': ' + str(e))
+        if self.call('nvmlInit_v2') != self.NVML_SUCCESS:
+            raise BackendError('nvmlInit failed')
+        self.handles = {}
+
+    def call(self, func, *args):
+        try:
+            return getattr(self.lib, func)(*args)
+        except AttributeError:
+            return -1               # not in this library version
+
+    def handle(self, gpu):
+        if gpu not in self.handles:
+            h = ctypes.c_void_p()
+            if self.call('nvmlDeviceGetHandleByIndex_v2', ctypes.c_uint(gpu), ctypes.byref(h)) != self.NVML_SUCCESS:
+                raise BackendError('no NVML device %d' % gpu)
+            self.handles[gpu] = h
+        return self.handles[gpu]
+
+    def uint(self, func, gpu, *args):
+        v = ctypes.c_uint()
+        if self.call(func, self.handle(gpu), *(args + (ctypes.byref(v),))) != self.NVML_SUCCESS:
+            return None
+        return v.value
+
+    def devices(self):
+        n = ctypes.c_uint()
+        if self.call('nvmlDeviceGetCount_v2', ctypes.byref(n)) != self.NVML_SUCCESS:
+            raise BackendError('nvmlDeviceGetCount failed')
+        return range(n.value)
+
+    def fans(self, gpu):
+        return range(self.uint('nvmlDeviceGetNumFans', gpu) or 1)
+
+    def read(self, gpu, keys=sample_keys):
+        h = self.handle(gpu)
+        mem = self.Memory()
+        mem_used = None
+        if self.call('nvmlDeviceGetMemoryInfo', h, ctypes.byref(mem)) == self.NVML_SUCCESS:
+            mem_used = mem.used // 2**20
+        util = self.Utilization()
+        if self.call('nvmlDeviceGetUtilizationRates', h, ctypes.byref(util)) == self.NVML_SUCCESS:
+            video, period = ctypes.c_uint(), ctypes.c_uint()    # utilization, sampling period in us
+            if self.call('nvmlDeviceGetEncoderUtilization', h, ctypes.byref(video),
+                         ctypes.byref(period)) == self.NVML_SUCCESS:
+                video = video.value
+            else:
+                video = None
+            util = {'graphics': util.gpu, 'memory': util.memory, 'video': video, 'PCIe': None}
+        else:
+            util = None
+        return pick({'temp': self.uint('nvmlDeviceGetTemperature', gpu, self.NVML_TEMPERATURE_GPU),
+                     'fan': self.uint('nvmlDeviceGetFanSpeed', gpu), 'rpm': None,
+                     'gfx_clock': self.uint('nvmlDeviceGetClockInfo', gpu, self.NVML_CLOCK_GRAPHICS),
+                     'mem_clock': self.uint('nvmlDeviceGetClockInfo', gpu, self.NVML_CLOCK_MEM),
+                     'mem_used': mem_used, 'util': util}, keys)
+
+    def info(self, gpu, keys=info_keys):
+        mem = self.Memory()
+        mem_total = None
+        if self.call('nvmlDeviceGetMemoryInfo', self.handle(gpu), ctypes.byref(mem)) == self.NVML_SUCCESS:
+            mem_total = mem.total // 2**20
+        buf = ctypes.create_string_buffer(80)
+        driver = None
+        if self.call('nvmlSystemGetDriverVersion', buf, ctypes.c_uint(80)) == self.NVML_SUCCESS:
+            driver = buf.value
+        max_gen = self.uint('nvmlDeviceGetMaxPcieLinkGeneration', gpu)
+        cur_gen = self.uint('nvmlDeviceGetCurrPcieLinkGeneration', gpu)
+        return pick({'pcie_gen': max_gen,
+                     'pcie_max_width': self.uint('nvmlDeviceGetMaxPcieLinkWidth', gpu),
+                     'pcie_cur_width': self.uint('nvmlDeviceGetCurrPcieLinkWidth', gpu),
+                     'pcie_max_speed': self.lane_speeds.get(max_gen),
+                     'pcie_cur_speed': self.lane_speeds.get(cur_gen),
+                     'mem_total': mem_total, 'cuda_cores': self.uint('nvmlDeviceGetNumGpuCores', gpu),
+                     'driver': driver}, keys)
+
+    def set_fan(self, gpu, speed):
+        for fan in self.fans(gpu):
+            if self.call('nvmlDeviceSetFanSpeed_v2', self.handle(gpu), ctypes.c_uint(fan), ctypes.c_uint(speed)) != self.NVML_SUCCESS:
+                raise BackendError('cannot set fan speed on NVML device %d (needs root and driver 520+)' % gpu)
+        return speed
+
+    def set_fan_control(self, gpu, manual):
+        if manual:
+            return True             # nvmlDeviceSetFanSpeed_v2 switches the fan to manual itself
+        ok = True
+        for fan in self.fans(gpu):
+            ok = self.call('nvmlDeviceSetDefaultFanSpeed_v2', self.handle(gpu), ctypes.c_uint(fan)) == self.NVML_SUCCESS and ok
+        return ok
+
+    def set_power_limit(self, gpu, fraction):
+        low, high = ctypes.c_uint(), ctypes.c_uint()
+        if self.call('nvmlDeviceGetPowerManagementLimitConstraints', self.handle(gpu), ctypes.byref(low),
+                     ctypes.byref(high)) != self.NVML_SUCCESS:
+            raise BackendError('NVML device %d has no power limit' % gpu)
+        default = self.uint('nvmlDeviceGetPowerManagementDefaultLimit', gpu) or high.value
+        limit = int(low.value + (default - low.value) * fraction)     # mW
+        if self.call('nvmlDeviceSetPowerManagementLimit', self.handle(gpu), ctypes.c_uint(limit)) != self.NVML_SUCCESS:
+            raise BackendError('cannot set the power limit of NVML device %d (needs root)' % gpu)
+        return limit / 1000
+# ----------------------------------------------------------------------------------------
+class HwmonBackend(Backend):
+    # Reads /sys/class/hwmon directly, for cards whose driver exports a hwmon device (nouveau,
+    # amdgpu, radeon). gpu N is the Nth hwmon directory given on the command line or, by default,
+    # the Nth one whose driver is in gpu_drivers. pwm1 is 0-255, pwm1_enable 1 is manual, 2 auto.
+    name = 'hwmon'
+    gpu_drivers = ('nouveau', 'amdgpu', 'radeon')
+
+    def __init__(self, dirs=None, root='/sys/class/hwmon'):
+        if dirs:
+            self.dirs = [d if d.startswith('/') else join(root, d) for d in dirs]
+        elif exists(root):
+            self.dirs = sorted(join(root, d) for d in listdir(root) if self.sysfs(join(root, d, 'name')) in self.gpu_drivers)
+        else:
+            self.dirs = []
+        if not self.dirs:
+            raise BackendError('no GPU hwmon devices under ' + root)
+
+    def sysfs(self, path, convert=str):
+        try:
+            with open(path) as f:
+                return convert(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def devices(self):
+        return range(len(self.dirs))
+
+    def path(self, gpu, name):
+        return join(self.dirs[gpu], name)
+
+    def read(self, gpu, keys=sample_keys):
+        temp = self.sysfs(self.path(gpu, 'temp1_input'), int)
+        pwm = self.sysfs(self.path(gpu, 'pwm1'), int)
+        gfx = self.sysfs(self.path(gpu, 'freq1_input'), int)
+        mem = self.sysfs(self.path(gpu, 'freq2_input'), int)
+        used = self.sysfs(self.path(gpu, 'device/mem_info_vram_used'), int)
+        busy = self.sysfs(self.path(gpu, 'device/gpu_busy_percent'), int)
+        return pick({'temp': None if temp is None else temp // 1000,
+                     'fan': None if pwm is None else int(round(pwm * 100 / 255)),
+                     'rpm': self.sysfs(self.path(gpu, 'fan1_input'), int),
+                     'gfx_clock': None if gfx is None else gfx // 1000000,
+                     'mem_clock': None if mem is None else mem // 1000000,
+                     'mem_used': None if used is None else used // 2**20,
+                     'util': None if busy is None else {'graphics': busy, 'memory': None, 'video': None, 'PCIe': None}},
+                    keys)
+
+    def info(self, gpu, keys=info_keys):
+        def lane_speed(s):
+            # e.g. '8.0 GT/s PCIe'
+            return int(float(s.split()[0]) * 1000)
+        total = self.sysfs(self.path(gpu, 'device/mem_info_vram_total'), int)
+        driver = self.sysfs(self.path(gpu, 'name'))
+        return pick({'pcie_gen': None,
+                     'pcie_max_width': self.sysfs(self.path(gpu, 'device/max_link_width'), int),
+                     'pcie_cur_width': self.sysfs(self.path(gpu, 'device/current_link_width'), int),
+                     'pcie_max_speed': self.sysfs(self.path(gpu, 'device/max_link_speed'), lane_speed),
+                     'pcie_cur_speed': self.sysfs(self.path(gpu, 'device/current_link_speed'), lane_speed),
+                     'mem_total': None if total is None else total // 2**20, 'cuda_cores': None,
+                     'driver': self.sysfs('/sys/module/%s/version' % driver) or driver}, keys)
+
+    def set_fan(self, gpu, speed):
+        with open(self.path(gpu, 'pwm1'), 'w') as f:
+            f.write(str(int(round(speed * 255 / 100))))
+        return speed
+
+    def set_fan_control(self, gpu, manual):
+        try:
+            with open(self.path(gpu, 'pwm1_enable'), 'w') as f:
+                f.write('1' if manual else '2')
+        except (IOError, OSError):
+            return False
+        return self.sysfs(self.path(gpu, 'pwm1_enable')) == ('1' if manual else '2')
+
+    def set_power_limit(self, gpu, fraction):
+        # power1_cap and its limits are in uW, amdgpu has them
+        low = self.sysfs(self.path(gpu, 'power1_cap_min'), int)
+        default = (self.sysfs(self.path(gpu, 'power1_cap_default'), int) or
+                   self.sysfs(self.path(gpu, 'power1_cap_max'), int))
+        if low is None or default is None:
+            raise BackendError(self.dirs[gpu] + ' has no power1_cap')
+        limit = int(low + (default - low) * fraction)
+        try:
+            with open(self.path(gpu, 'power1_cap'), 'w') as f:
+                f.write(str(limit))
+        except (IOError, OSError) as e:
+            raise BackendError('cannot set ' + self.path(gpu, 'power1_cap') + ': ' + str(e))
+        return limit / 1e6
+# ----------------------------------------------------------------------------------------
+class ReplayBackend(Backend):
+    # Plays back a trace recorded with --record (see record_sample()) so the controller and the
+    # screen can be run and benchmarked on a machine with no GPU. Each read() returns the next
+    # recorded sample for that gpu and wraps around at the end of the trace. Fan writes are
+    # accepted and remembered but of course don't change the recorded temperatures.
+    name = 'replay'
+
+    def __init__(self, path):
+        self.samples, self.infos, self.pos, self.fans = {}, {}, {}, {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    rec = json.loads(line)
+                    gpu = rec.get('gpu', 0)
+                    if 'info' in rec:
+                        self.infos[gpu] = rec['info']
+                    else:
+                        self.samples.setdefault(gpu, []).append(dict((k, rec.get(k)) for k in sample_keys))
+        except (IOError, ValueError) as e:
+            raise BackendError('cannot read trace ' + path + ': ' + str(e))
+        if not self.samples:
+            raise BackendError('trace ' + path + ' has no samples')
+
+    def devices(self):
+        return sorted(self.samples)
+
+    def read(self, gpu, keys=sample_keys):
+        samples = self.samples[gpu]
+        i = self.pos.get(gpu, 0)
+        self.pos[gpu] = (i + 1) % len(samples)
+        return pick(samples[i], keys)
+
+    def info(self, gpu, keys=info_keys):
+        return pick(self.infos.get(gpu, {}), keys)
+
+    def set_fan(self, gpu, speed):
+        self.fans[gpu] = speed
+        return speed
+
+    def set_fan_control(self, gpu, manual):
+        return True
+# ----------------------------------------------------------------------------------------
+# graphics utilization (percent) against seconds since the start, the loads SimBackend and
+# bench/sim_controllers.py put on a simulated card
+load_profiles = {
+    'idle': lambda t: 0,
+    'full': lambda t: 100,
+    'job_start': lambda t: 0 if t < 300 else 100,
+    'job_end': lambda t: 100 if t < 300 else 0,
+    'bursty': lambda t: 100 if (t // 300) % 2 else 10,
+    'ramp': lambda t: min(100, t / 6),
+    'boinc': lambda t: 0 if t % 600 < 15 else (100, 70, 95, 40)[int(t // 600) % 4],   # task changes
+}
+# ----------------------------------------------------------------------------------------
+class ThermalPlant(object):
+    # A card as two lumps of heat capacity: the die, heated by a power that grows with
+    # utilization, and the heatsink it sits on, cooled to the air by a fan that takes fan_lag
+    # seconds to spin up or down. Crude but it has what makes a fan hard to control, a slow
+    # heatsink between the fan and the sensor. Units are W, J/K, K/W and W/K.
+    ambient = 30.0
+    idle_power, max_power = 30.0, 200.0
+    die_capacity = 50.0
+    sink_capacity = 600.0
+    die_to_sink = 0.03
+    sink_to_air, per_fan = 1.0, 6.8         # W/K with the fan stopped, more per 100% of fan
+    fan_lag = 3.0
+    rpm_per_percent = 30
+    resume_lag = 10.0                       # seconds a suspended GPU task takes to get going again
+    step = 0.1
+
+    def __init__(self, profile, fan=70):
+        self.profile = profile
+        self.time = 0.0
+        self.fan = self.command = fan
+        self.suspended_until = float('-inf')    # GPU work is off until then, see suspend()
+        self.power_cap = 1.0                    # fraction of the load's extra power allowed
+        # start settled at the first load
+        power = self.power()
+        self.sink = self.ambient + power / self.cooling()
+        self.die = self.sink + power * self.die_to_sink
+
+    def power(self):
+        return self.idle_power + (self.max_power - self.idle_power) * self.util() / 100 * self.power_cap
+
+    def util(self):
+        if self.time < self.suspended_until + self.resume_lag:
+            return 0
+        return load_profiles[self.profile](self.time)
+
+    def suspend(self, seconds):
+        # what boinccmd --set_gpu_mode never <seconds> does to the card's load
+        self.suspended_until = self.time + seconds
+
+    def cooling(self):
+        return self.sink_to_air + self.per_fan * self.fan / 100
+
+    def advance(self, until):
+        while self.time < until:
+            dt = min(self.step, until - self.time)
+            to_sink = (self.die - self.sink) / self.die_to_sink
+            self.die += (self.power() - to_sink) * dt / self.die_capacity
+            self.sink += (to_sink - self.cooling() * (self.sink - self.ambient)) * dt / self.sink_capacity
+            self.fan += (self.command - self.fan) * min(1, dt / self.fan_lag)
+            self.time += dt
+# ----------------------------------------------------------------------------------------
+class SimBackend(Backend):
+    # A ThermalPlant per card, one load profile each, advanced to the time of every read. Runs
+    # in real time from the command line (--backend=sim:job_start,bursty), faster than that
+    # when bench/sim_controllers.py swaps the clock.
+    name = 'sim'
+
+    def __init__(self, profiles):
+        for p in profiles:
+            if p not in load_profiles:
+                raise BackendError('unknown load profile ' + p + ', try ' + ', '.join(sorted(load_profiles)))
+        self.plants = [ThermalPlant(p) for p in profiles]
+        self.began = time()
+
+    def devices(self):
+        return range(len(self.plants))
+
+    def read(self, gpu, keys=sample_keys):
+        plant = self.plants[gpu]
+        plant.advance(time() - self.began)
+        util = int(plant.util())
+        return pick({'temp': int(round(plant.die)), 'fan': plant.command,
+                     'rpm': int(plant.fan * plant.rpm_per_percent),
+                     'gfx_clock': 324 + util * 7, 'mem_clock': 3004 if util else 324, 'mem_used': 40 + util * 10,
+                     'util': {'graphics': util, 'memory': util // 3, 'video': 0, 'PCIe': util // 20}}, keys)
+
+    def info(self, gpu, keys=info_keys):
+        return pick({'pcie_gen': 3, 'pcie_max_width': 16, 'pcie_cur_width': 16, 'pcie_max_speed': 8000,
+                     'pcie_cur_speed': 8000, 'mem_total': 2048, 'cuda_cores': 1344, 'driver': 'simulated'}, keys)
+
+    def set_fan(self, gpu, speed):
+        self.plants[gpu].command = speed
+        return speed
+
+    def set_fan_control(self, gpu, manual):
+        return True
+
+    def set_power_limit(self, gpu, fraction):
+        self.plants[gpu].power_cap = fraction
+        return ThermalPlant.idle_power + (ThermalPlant.max_power - ThermalPlant.idle_power) * fraction
+# ----------------------------------------------------------------------------------------
+class CachedBackend(Backend):
+    # Sits in front of another backend so only what can have changed is read from the card.
+    # Every key of sample_keys and info_keys is in one of three tiers (attr_tiers): static
+    # values are read once for the life of the process, slow ones at most every slow_ttl
+    # seconds and fast ones on every read. A fan speed write is skipped when the card was
+    # already set to that speed less than fan_rewrite seconds ago, the periodic rewrite puts
+    # the speed back should the driver have reset it behind our back.
+    attr_tiers = {'pcie_gen': 'static', 'pcie_max_width': 'static', 'pcie_cur_width': 'static',
+                  'pcie_max_speed': 'static', 'mem_total': 'static', 'cuda_cores': 'static',
+                  'driver': 'static', 'pcie_cur_speed': 'slow', 'mem_used': 'slow',
+                  'temp': 'fast', 'fan': 'fast', 'rpm': 'fast', 'gfx_clock': 'fast',
+                  'mem_clock': 'fast', 'util': 'fast'}
+    fan_rewrite = 60
+
+    def __init__(self, backend, slow_ttl=10):
+        self.backend = backend
+        self.name = backend.name
+        self.slow_ttl = slow_ttl
+        self.values = {}        # (gpu, key) -> (value, time read)
+        self.fans = {}          # gpu -> (speed, time written)
+        self.counts = {}        # gpu -> {'hits': n, 'misses': n, 'writes': n, 'writes_skipped': n}
+
+    def stats(self, gpu):
+        return self.counts.setdefault(gpu, {'hits': 0, 'misses': 0, 'writes': 0, 'writes_skipped': 0})
+
+    def devices(self):
+        return self.backend.devices()
+
+    def cached(self, gpu, keys, fetch):
+        now = time()
+        stats = self.stats(gpu)
+        result, missing = {}, []
+        for k in keys:
+            tier = self.attr_tiers[k]
+            entry = self.values.get((gpu, k))
+            if entry and (tier == 'static' or (tier == 'slow' and now - entry[1] < self.slow_ttl)):
+                result[k] = entry[0]
+            else:
+                missing.append(k)
+        stats['hits'] += len(keys) - len(missing)
+        stats['misses'] += len(missing)
+        if missing:
+            fresh = fetch(gpu, missing)
+            for k in missing:
+                if self.attr_tiers[k] != 'fast' and fresh[k] is not None:
+                    self.values[(gpu, k)] = (fresh[k], now)
+            result.update(fresh)
+        return result
+
+    def read(self, gpu, keys=sample_keys):
+        return self.cached(gpu, keys, self.backend.read)
+
+    def info(self, gpu, keys=info_keys):
+        return self.cached(gpu, keys, self.backend.info)
+
+    def set_fan(self, gpu, speed):
+        stats = self.stats(gpu)
+        last = self.fans.get(gpu)
+        if last and last[0] == speed and time() - last[1] < self.fan_rewrite:
+            stats['writes_skipped'] += 1
+            return speed
+        stats['writes'] += 1
+        speed = self.backend.set_fan(gpu, speed)
+        self.fans[gpu] = (speed, time())
+        return speed
+
+    def set_fan_control(self, gpu, manual):
+        self.fans.pop(gpu, None)
+        return self.backend.set_fan_control(gpu, manual)
+
+    def start(self, gpu, speed):
+        self.stats(gpu)['writes'] += 1
+        speed = self.backend.start(gpu, speed)
+        if speed is not None:
+            self.fans[gpu] = (speed, time())
+        return speed
+
+    def set_power_limit(self, gpu, fraction):
+        return self.backend.set_power_limit(gpu, fraction)
+
+    def manifest(self):
+        # the backend's topology plus every card's static info
+        manifest = self.backend.manifest()
+        if manifest is not None:
+            manifest['info'] = {}
+            for (gpu, k), (value, read) in self.values.items():
+                if self.attr_tiers[k] == 'static':
+                    manifest['info'].setdefault(str(gpu), {})[k] = value
+        return manifest
+
+    def restore(self, manifest):
+        for gpu, info in manifest.get('info', {}).items():
+            for k, value in info.items():
+                self.values[(int(gpu), k)] = (value, 0)
+        return self.backend.restore(manifest)
+# ----------------------------------------------------------------------------------------
+class TimedBackend(Backend):
+    # Sits between CachedBackend and the backend that talks to the card and times every call
+    # that gets that far, see Metrics
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    def devices(self):
+        with metrics.timed('call', 'devices'):
+            return self.backend.devices()
+
+    def read(self, gpu, keys=sample_keys):
+        with metrics.timed('call', 'read'):
+            return self.backend.read(gpu, keys)
+
+    def info(self, gpu, keys=info_keys):
+        with metrics.timed('call', 'info'):
+            return self.backend.info(gpu, keys)
+
+    def set_fan(self, gpu, speed):
+        with metrics.timed('call', 'set_fan'):
+            return self.backend.set_fan(gpu, speed)
+
+    def set_fan_control(self, gpu, manual):
+        with metrics.timed('call', 'set_fan_control'):
+            return self.backend.set_fan_control(gpu, manual)
+
+    def start(self, gpu, speed):
+        with metrics.timed('call', 'start'):
+            return self.backend.start(gpu, speed)
+
+    def set_power_limit(self, gpu, fraction):
+        with metrics.timed('call', 'set_power_limit'):
+            return self.backend.set_power_limit(gpu, fraction)
+
+    def manifest(self):
+        return self.backend.manifest()
+
+    def restore(self, manifest):
+        return self.backend.restore(manifest)
+# ----------------------------------------------------------------------------------------
+def record_sample(f, gpu, sample, info=None):
+    # Append one line of trace to the open file f in the format ReplayBackend reads, a JSON
+    # object per line. Static info is written as {"gpu": n, "info": {...}}.
+    with record_lock:       # cards are sampled from several threads
+        if info is not None:
+            f.write(json.dumps({'gpu': gpu, 'info': info}) + '\n')
+        if sample is not None:
+            rec = dict(sample)
+            rec['gpu'] = gpu
+            rec['time'] = round(time(), 3)
+            f.write(json.dumps(rec) + '\n')
+        f.flush()
+# ----------------------------------------------------------------------------------------
+def make_backend(spec):
+    # spec is the value of --backend: nvidia-settings[:display], nvml, hwmon[:hwmonN,...],
+    # replay:trace_file or sim[:profile,...]
+    name, _, arg = spec.partition(':')
+    if name == 'nvidia-settings':
+        return NvidiaSettingsBackend(arg or 'localhost:0')
+    elif name == 'nvml':
+        return NvmlBackend()
+    elif name == 'hwmon':
+        return HwmonBackend(arg.split(',') if arg else None)
+    elif name == 'replay' and arg:
+        return ReplayBackend(arg)
+    elif name == 'sim':
+        return SimBackend((arg or 'job_start').split(','))
+    raise BackendError('unknown backend ' + spec)
+# ----------------------------------------------------------------------------------------
+def nvidia_driver_version():
+    # version of the loaded kernel module, from /proc so it costs no subprocess, None without
+    # the NVIDIA driver
+    try:
+        with open('/proc/driver/nvidia/version') as f:
+            m = re.search(r'Kernel Module\s+(\S+)', f.read())
+    except IOError:
+        return None
+    return m and m.group(1)
+# ----------------------------------------------------------------------------------------
+def nvidia_cards():
+    # the cards the driver has, 'bus id model uuid' each, from /proc so it costs no subprocess.
+    # A card added, removed or swapped for another in the same slot changes the list.
+    root = '/proc/driver/nvidia/gpus'
+    cards = []
+    try:
+        for bus in sorted(listdir(root)):
+            with open(join(root, bus, 'information')) as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+            cards.append(' '.join([bus] + [fields.get(k, '').strip() for k in ('Model', 'GPU UUID')]))
+    except (IOError, OSError):
+        return None
+    return cards
+# ----------------------------------------------------------------------------------------
+def load_manifest(spec, driver, cards):
+    # The capability manifest holds what the backend found on an earlier run with the same
+    # --backend under the same driver version with the same cards: the gpus, which fans are
+    # whose, every card's static info and the attributes the driver doesn't have
+    # (see Backend.manifest()). With it startup needs no probing, only the call that takes the
+    # fans. None if there's no manifest for this backend or it was made under another driver
+    # or with other cards.
+    try:
+        with open(join(manifest_dir, 'manifest.json')) as f:
+            manifest = json.load(f).get(spec)
+    except (IOError, ValueError):
+        return None
+    if not manifest or manifest.get('driver') != driver or manifest.get('version') != manifest_version:
+        return None
+    if manifest.get('cards') != cards:
+        log.info('the cards changed since the capability manifest was written, probing them')
+        return None
+    return manifest
+# ----------------------------------------------------------------------------------------
+def save_manifest(spec, driver, cards):
+    global manifest_pending
+    manifest_pending = None
+    manifest = backend.manifest()
+    if manifest is None: return
+    manifest['driver'] = driver
+    manifest['cards'] = cards
+    manifest['version'] = manifest_version
+    path = join(manifest_dir, 'manifest.json')
+    try:
+        try:
+            with open(path) as f:
+                manifests = json.load(f)
+        except (IOError, ValueError):
+            manifests = {}
+        manifests[spec] = manifest
+        if not exists(manifest_dir): os.makedirs(manifest_dir)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifests, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+        log.info('capability manifest for driver %s written to %s', driver, path)
+    except (IOError, OSError) as e:
+        log.warning('cannot write %s: %s', path, e)
+# ----------------------------------------------------------------------------------------
+class AdaptiveScheduler(object):
+    # Decides how long a card waits for its next tick. While the temperature or the load is
+    # moving, or the temperature is outside the tolerance band, the card is ticked every
+    # min_period seconds. Every stable tick after that doubles the period up to max_period.
+    # max_period is capped at safety_period whatever the command line says so no card is ever
+    # left unwatched for longer than that.
+    safety_period = 60
+    temp_step = 1           # C change between ticks that counts as moving
+    util_step = 10          # graphics utilization change (percent points) that counts as moving
+
+    def __init__(self, min_period, max_period, period):
+        self.max_period = min(max_period, self.safety_period)
+        self.min_period = min(min_period, self.max_period)
+        self.period = max(self.min_period, min(period, self.max_period))
+
+    def update(self, temp_delta, util_delta, out_of_band):
+        if abs(temp_delta) >= self.temp_step or util_delta >= self.util_step or out_of_band:
+            self.period = self.min_period
+        else:
+            self.period = min(self.period * 2, self.max_period)
+        return self.period
+# ----------------------------------------------------------------------------------------
+class FanRule(object):
+    # How a card's next fan speed is chosen, --controller on the command line. decide() is
+    # given the card's GpuController (target, tolerance, fan limits, current_speed and
+    # temp_delta), the temperature just read, the card's graphics utilization and the seconds
+    # since the card's last tick and returns the new fan speed within the card's fan limits.
+    # Each card has its own instance so a rule can keep state between ticks.
+    name = None
+
+    def decide(self, c, temp, util, dt):
+        raise NotImplementedError
+# ----------------------------------------------------------------------------------------
+class StepRule(FanRule):
+    # The original rule and still the default.
+    name = 'step'
+
+    def decide(self, c, temp, util, dt):
+        # The way it works is simple. If the temp is not between acceptable limits (the target
+        # temp +/- tolerance) we take corrective action unless the temp_delta indicates the
+        # temperature is already going in the desired direction. Without tracking and using
+        # temp_delta the NTSNWB (not too sophisticated, never will be) algorithm tends to
+        # over-correct which can produce wild and unnecessary swings in fan speed due to
+        # temperature<->(cooling effect) hysteresis I guess.
+        new_speed = c.current_speed
+        if temp > c.target + c.tolerance:
+            if c.temp_delta > -1:
                 # temp either did not change or it increased, attempt correction
-                new_speed = current_speed + (current_temp - target_temp)
-                if new_speed > 80:
-                    new_speed = 80
-                                         
-        elif current_temp < target_temp - tolerance:
-            if temp_delta < 1:
+                new_speed = c.current_speed + (temp - c.target)
+                if new_speed > c.fan_high:
+                    new_speed = c.fan_high
+        elif temp < c.target - c.tolerance:
+            if c.temp_delta < 1:
                 # temp either did not change or it decreased, attempt correction
-                new_speed = chek_new_speed(current_speed - (target_temp - current_temp))
-
-        freqs = get_gpu_info('GPUCurrentClockFreqs').split(',')
-
-        col1, col2 = 14, 35
-        put_text(win, 2, col1, '99', False)
-        put_text(win, 3, col1, x[0].split()[1], False)
-        put_text(win, 4, col1, x[1].split()[1], False)
-        put_text(win, 5, col1, x[2].split()[1], False)
-        put_text(win, 6, col1, x[3].split()[1], False)
-        put_text(win, 8, col1, str(target_temp), False)
-        put_text(win, 9, col1, str(current_temp), False)
-        put_text(win, 10, col1, str(temp_delta) + '  ', False)
-        put_text(win, 12, col1, str(current_speed), False)
-        put_text(win, 13, col1, str(new_speed - current_speed) + '  ', False)
-        put_text(win, 14, col1, get_rpm() + 'v ', False)
-
-        put_text(win, 8, col2, freqs[0], False)
-        put_text(win, 9, col2, freqs[1], False)
-        put_text(win, 12, col2, get_gpu_info('UsedDedicatedGPUMemory'), False)
-        put_text(win, 12, col2, get_gpu_info('UsedDedicatedGPUMemory'), False)
-        put_text(win, 12, col2, get_gpu_info('UsedDedicatedGPUMemory'), False)
-        # GPUCurrentClockFreqsString
-        
-        #put_text(win, 13, col2, get_gpu_info('CUDACores'), False)
-        put_text(win, 15, 1, ' ', True)
-        put_text(win, 16, 1, 'Press q to exit', True)
-
-        '''put_text(win, 2, col2, 'PCIe')
-        put_text(win, 3, col2, x[0].split()[1])
-        put_text(win, 4, col1, x[1].split()[1])
-        put_text(win, 5, col1, x[2].split()[1])
-        put_text(win, 6, col1, x[3].split()[1])
-        put_text(win, 8, col1, str(target_temp))
-        put_text(win, 9, col1, str(current_temp))
-        put_text(win, 10, col1, str(temp_delta))
-        put_text(win, 12, col1, str(current_speed))
-        put_text(win, 13, col1, str(new_speed - current_speed))
-        put_text(win, 14, col1, get_rpm())
-        put_text(win, 15, 1, ' ')'''
-        win.box()
-
-        pflush()
-        #p1.window().refresh()
-        current_speed = set_speed(new_speed)
-        previous_temp = current_temp
-
-        count = 0
-        while count < 5:
-            if stdscr.getch() == ord('q'): return() 
-            else:
-                sleep (1)
-                count += 1
-        #if wait_a_while() == 'q': exit()
-        #if Getchar() == 'q': exit()
-
-# ----------------------------------------------------------------------------------------
-def get_nvidia_info(query):
-    return check_output(['nvidia-settings', '--query', 'localhost:0.0/' + query, '-t'])
-# ----------------------------------------------------------------------------------------
-def get_gpu_info(query):
-    return check_output(['nvidia-settings', '--query', 'localhost:0[gpu:0]/' + query, '-t'])
-# ----------------------------------------------------------------------------------------
-def get_utilization():
-    # returns a string of 4 numbers that are percentages : graphics, memory, video, PCIe
-    x = check_output(['nvidia-settings', '--query', 'localhost:0[gpu:0]/GPUUtilization', '-t']).strip().replace(' ', '').replace('=', ': ')
-    #print 'x:', x
-    #print 'x split:', x.split(',')
-    #for i in range(3):
-    #    x[i].replace('=', ': ')
-    return x
-# ----------------------------------------------------------------------------------------
-def set_speed(speed):
-    x = check_output(['nvidia-settings', '--assign', 'localhost:0[fan:0]/GPUCurrentFanSpeed=' + str(speed), '-t'])
-    return (int(x[x.rfind(' ') + 1:x.rfind('.')]))  # return current fan speed
-# ----------------------------------------------------------------------------------------    
-def get_temp():
-    return (int(check_output(['nvidia-settings', '--query', 'localhost:0[thermalsensor:0]/ThermalSensorReading', '-t'])))
+                new_speed = chek_new_speed(c.current_speed - (c.target - temp),
+                                           c.fan_low, c.fan_high)
+        return new_speed
+# ----------------------------------------------------------------------------------------
+class PidRule(FanRule):
+    # PID on the temperature error with utilization feed-forward. The step rule only reacts
+    # once the temperature has moved, by then the heatsink has soaked up the new load and the
+    # fan overshoots and hunts for minutes. Here a change in load moves the fan straight away
+    # by ff * (change in utilization) * (fan range), the PID terms only trim what's left.
+    #   kp  fan % per C of error
+    #   ki  fan % per C of error per second, integrated only outside the tolerance band so
+    #       the integer readings don't keep the fan creeping
+    #   kd  fan % per C/s of temperature slope, the slope is smoothed over smoothing seconds
+    #       and taken from the measurement rather than the error so a new target doesn't kick
+    # The integral is clamped to what the fan limits can deliver (no wind-up while the fan is
+    # pinned) and starts where it makes the first output the speed the card is at. Changes
+    # smaller than min_change are skipped inside the band to save fan writes.
+    name = 'pid'
+    smoothing = 10
+    min_change = 2
+
+    def __init__(self, kp=8, ki=0.01, kd=40, ff=0.6):
+        self.kp, self.ki, self.kd, self.ff = kp, ki, kd, ff
+        self.integral = None
+        self.previous = None
+        self.slope = 0
+
+    def decide(self, c, temp, util, dt):
+        error = temp - c.target
+        feed = self.ff * util / 100 * (c.fan_high - c.fan_low)
+        if self.previous is not None and dt > 0:
+            self.slope += ((temp - self.previous) / dt - self.slope) * min(1, dt / self.smoothing)
+        self.previous = temp
+        if self.integral is None:
+            self.integral = c.current_speed - feed - self.kp * error - self.kd * self.slope
+        elif abs(error) > c.tolerance:
+            self.integral += self.ki * error * dt
+        self.integral = max(c.fan_low - feed, min(self.integral, c.fan_high - feed))
+        new_speed = int(round(self.integral + feed + self.kp * error + self.kd * self.slope))
+        new_speed = chek_new_speed(new_speed, c.fan_low, c.fan_high)
+        if abs(error) <= c.tolerance and abs(new_speed - c.current_speed) < self.min_change:
+            return c.current_speed
+        return new_speed
+# ----------------------------------------------------------------------------------------
+def make_rule(spec):
+    # spec is the value of --controller: step or pid[:kp[:ki[:kd[:ff]]]]
+    name, _, args = spec.partition(':')
+    if name == 'step' and not args:
+        return StepRule()
+    elif name == 'pid':
+        gains = [float(v) for v in args.split(':') if v]
+        if len(gains) <= 4: return PidRule(*gains)
+    raise ValueError('unknown controller ' + spec)
+# ----------------------------------------------------------------------------------------
+class FanFailureDetector(object):
+    # Watches a card for a dead or dying fan: hot while the fan turns far slower than the speed
+    # it was set to should make it. Two moving averages over about fan_confirm seconds are
+    # kept, of the fan's rpm relative to what it did per percent while healthy and of the
+    # fraction of time the card is above its band, so the state per card is a few numbers
+    # whatever the sampling rate. Once both have looked bad for fan_confirm seconds the fault is
+    # confirmed and fan_failure() runs the --on-fan-failure actions, once, until the fan has
+    # looked healthy again for as long. Backends that don't report rpm aren't checked.
+    min_ratio = 0.3         # rpm below this fraction of the healthy rpm looks dead
+    min_rpm = 300           # and below this at any speed
+    hot_fraction = 0.5
+
+    def __init__(self):
+        self.healthy = None         # rpm per percent of fan speed while all is well
+        self.ratio = 1.0            # moving average of rpm / healthy rpm
+        self.hot = 0.0              # moving average of time above the band
+        self.bad_for = 0.0          # seconds both averages have looked bad
+        self.good_for = 0.0
+        self.tripped = False
+
+    def update(self, c, sample, dt):
+        rpm, fan = sample['rpm'], c.current_speed
+        if rpm is None or fan <= 0: return
+        dt = min(dt, AdaptiveScheduler.safety_period)
+        weight = min(1, dt / fan_confirm)
+        per = rpm / fan
+        if self.healthy is None:
+            self.healthy = per
+        ratio = 0 if rpm < self.min_rpm else per / self.healthy if self.healthy else 1
+        self.ratio += (ratio - self.ratio) * weight
+        self.hot += ((sample['temp'] > c.target + c.tolerance) - self.hot) * weight
+        if self.ratio < self.min_ratio and self.hot > self.hot_fraction:
+            self.bad_for += dt
+            self.good_for = 0
+        else:
+            self.bad_for = 0
+            self.good_for += dt
+            if ratio > 0.7:     # learn what the fan does slowly, a dying fan can't teach it much
+                self.healthy += (per - self.healthy) * weight / 10
+        if not self.tripped and self.bad_for >= fan_confirm:
+            self.tripped = True
+            fan_failure(c, sample, 'fan_failure')
+        elif self.tripped and self.good_for >= fan_confirm:
+            self.tripped = False
+            fan_failure(c, sample, 'fan_recovered')
+# ----------------------------------------------------------------------------------------
+def fan_failure(c, sample, event):
+    # Runs the --on-fan-failure actions for a card, on the card's pool thread:
+    #   alarm       log it and ring the terminal bell, if stdout is a terminal
+    #   boinc       stop BOINC using GPUs, boinccmd --set_gpu_mode never
+    #   hook:cmd    run cmd through the shell with GPU_D_EVENT (fan_failure or fan_recovered),
+    #               GPU_D_GPU, GPU_D_TEMP, GPU_D_RPM and GPU_D_FAN set
+    #   exit        restore automatic fan control at full speed and exit, see tick_done()
+    # On recovery only the log message and the hook run, BOINC is left for the user to resume.
+    if event == 'fan_failure':
+        log.critical('GPU %d: fan failure? %s rpm at %d%% fan, %s C against a target of %d for %gs',
+                     c.gpu, sample['rpm'], c.current_speed, sample['temp'], c.target, fan_confirm)
+    else:
+        log.warning('GPU %d: fan looks healthy again, %s rpm at %d%% fan', c.gpu, sample['rpm'], c.current_speed)
+    for action in fault_actions:
+        try:
+            if action == 'alarm' and event == 'fan_failure' and stdout.isatty():
+                stdout.write('\a')     # not into a log stream, there the log line is the alarm
+                stdout.flush()
+            elif action == 'boinc' and event == 'fan_failure':
+                boinc_gpu_mode('never')
+                log.warning('GPU %d: BOINC GPU work suspended', c.gpu)
+            elif action.startswith('hook:'):
+                env = dict(os.environ, GPU_D_EVENT=event, GPU_D_GPU=str(c.gpu), GPU_D_TEMP=str(sample['temp']),
+                           GPU_D_RPM=str(sample['rpm']), GPU_D_FAN=str(c.current_speed))
+                check_output(action[5:], shell=True, env=env)
+            elif action == 'exit' and event == 'fan_failure':
+                c.fault_exit = True
+        except (CalledProcessError, OSError) as e:
+            log.error('GPU %d: --on-fan-failure %s failed: %s', c.gpu, action.partition(':')[0], e)
+# ----------------------------------------------------------------------------------------
+def parse_fault_actions(spec):
+    # the value of --on-fan-failure, a comma separated list of alarm, boinc, exit and
+    # hook:cmd, which takes the rest of the value so cmd can have commas
+    actions = []
+    while spec:
+        if spec.startswith('hook:'):
+            actions.append(spec)
+            break
+        action, _, spec = spec.partition(',')
+        if action not in ('alarm', 'boinc', 'exit', 'none'):
+            raise ValueError('unknown --on-fan-failure action ' + action)
+        if action != 'none': actions.append(action)
+    return actions
+# ----------------------------------------------------------------------------------------
+def boinc_gpu_mode(mode, seconds=0):
+    # boinccmd --set_gpu_mode, mode is always, auto or never. After seconds BOINC goes back to
+    # the mode it had by itself, 0 makes the change for good.
+    check_output([boinccmd, '--set_gpu_mode', mode, str(int(seconds))])
 # ----------------------------------------------------------------------------------------
-def get_rpm():
-    return check_output(['nvidia-settings', '--query', 'localhost:0[fan:0]/GPUCurrentFanSpeedRPM', '-t'])        
+class LoadGovernor(object):
+    # The stage after the fan rule, --throttle on the command line. Once the fan is at the
+    # card's fan_high and the temperature is still above the band there's nothing more the fan
+    # can do, so instead of suspending all GPU work the card's duty, the fraction of the time
+    # work may run, is cut by cut_rate per C above the band per minute. Back at or below target
+    # it's given back at restore_rate per C below target (at least 1) per minute, and until it's
+    # all back the fan stays at fan_high, see GpuController.tick(). Duty-cycled work heats the
+    # die in bursts of a few seconds, so the temperature looked at is averaged over
+    # throttle_period. apply_throttle() puts the duty into effect.
+    cut_rate = 0.1
+    restore_rate = 0.1
+    min_duty = 0.1
+
+    def __init__(self):
+        self.duty = 1.0
+        self.temp = None            # moving average of the temperature over throttle_period
+
+    def update(self, c, temp, dt):
+        dt = min(dt, AdaptiveScheduler.safety_period)
+        if self.temp is None: self.temp = temp
+        self.temp += (temp - self.temp) * min(1, dt / throttle_period)
+        over = self.temp - (c.target + c.tolerance)
+        if over > 0 and c.current_speed >= c.fan_high:
+            self.duty -= self.cut_rate * over * dt / 60
+        elif self.temp <= c.target:
+            self.duty += self.restore_rate * max(1, c.target - self.temp) * dt / 60
+        self.duty = max(self.min_duty, min(1.0, self.duty))
+        return self.duty
+# ----------------------------------------------------------------------------------------
+def apply_throttle():
+    # Runs on the pool every throttle_period seconds and puts the cards' duty into effect:
+    #   boinc       BOINC's GPU mode is for the whole host so the lowest duty counts, GPU work is
+    #               suspended for the first (1 - duty) of each period with boinccmd
+    #               --set_gpu_mode never N and BOINC resumes it by itself, also if we die
+    #   power       the card's power limit, see Backend.set_power_limit()
+    #   hook:cmd    run cmd through the shell with GPU_D_EVENT=throttle, GPU_D_GPU, GPU_D_DUTY
+    #               (0.1 to 1) and GPU_D_PERIOD set
+    # Limits and hooks are only touched when a card's duty moved by duty_step or got back to 1.
+    if throttle_mode == 'boinc':
+        off = int(round((1 - min(c.duty for c in controllers)) * throttle_period))
+        if off:
+            try:
+                boinc_gpu_mode('never', off)
+            except (CalledProcessError, OSError) as e:
+                log.error('--throttle=boinc failed: %s', e)
+    for c in controllers:
+        if c.duty == c.applied_duty or (abs(c.duty - c.applied_duty) < duty_step and c.duty < 1):
+            continue
+        try:
+            if throttle_mode == 'power':
+                log.info('GPU %d: power limit %.0f W', c.gpu, backend.set_power_limit(c.gpu, c.duty))
+            elif throttle_mode.startswith('hook:'):
+                env = dict(os.environ, GPU_D_EVENT='throttle', GPU_D_GPU=str(c.gpu),
+                           GPU_D_DUTY='%.2f' % c.duty, GPU_D_PERIOD='%g' % throttle_period)
+                check_output(throttle_mode[5:], shell=True, env=env)
+        except (BackendError, CalledProcessError, OSError) as e:
+            log.error('GPU %d: --throttle %s failed: %s', c.gpu, throttle_mode.partition(':')[0], e)
+        log.info('GPU %d: duty %d%% at %s C, fan %d%%', c.gpu, round(c.duty * 100),
+                 (c.sample or {}).get('temp'), c.current_speed)
+        c.applied_duty = c.duty
+# ----------------------------------------------------------------------------------------
+def parse_throttle(spec):
+    # the value of --throttle: boinc, power, hook:cmd or none
+    if spec in ('boinc', 'power') or spec.startswith('hook:'):
+        return spec
+    if spec == 'none':
+        return None
+    raise ValueError('unknown --throttle ' + spec)
+# ----------------------------------------------------------------------------------------
+def utilization(sample):
+    # graphics utilization of a sample, 0 if the backend doesn't report it
+    if not sample or not sample['util'] or sample['util'].get('graphics') is None:
+        return 0
+    return sample['util']['graphics']
+# ----------------------------------------------------------------------------------------
+class History(object):
+    # Fixed size ring buffer of a card's readings. Each column is an array of machine numbers
+    # rather than a list of sample dicts so memory stays the same after a week as after the
+    # first hour. A reading the backend couldn't provide is stored as -1.
+    columns = (('time', 'd'), ('temp', 'h'), ('fan', 'h'), ('rpm', 'i'), ('gfx_clock', 'i'),
+               ('mem_clock', 'i'), ('util', 'h'), ('mem_used', 'i'))
+
+    def __init__(self, size):
+        self.size = size
+        self.data = dict((name, array(code, [0]) * size) for name, code in self.columns)
+        self.head = 0               # slot the next reading goes in
+        self.count = 0
+
+    def append(self, row):
+        # row is a dict with the names in columns
+        for name, code in self.columns:
+            value = row.get(name)
+            self.data[name][self.head] = -1 if value is None else value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self, name, n):
+        # up to n of the most recent values of a column, oldest first
+        n = min(n, self.count)
+        column = self.data[name]
+        start = (self.head - n) % self.size
+        if start + n <= self.size:
+            return column[start:start + n].tolist()
+        return column[start:].tolist() + column[:self.head].tolist()
+# ----------------------------------------------------------------------------------------
+def history_row(c):
+    # the History columns of a card's last tick
+    sample = c.sample
+    return {'time': c.tick_started, 'temp': sample['temp'], 'fan': c.current_speed,
+            'rpm': sample['rpm'], 'gfx_clock': sample['gfx_clock'], 'mem_clock': sample['mem_clock'],
+            'util': utilization(sample) if sample['util'] else None, 'mem_used': sample['mem_used']}
 # ----------------------------------------------------------------------------------------
-def chek_new_speed(speed):
-    # speed must be between 1 and 100 else set_speed() crashes
-    if speed > fan_speed_up_lim: return(fan_speed_up_lim) 
-    elif speed < fan_speed_low_lim: return (fan_speed_low_lim)
+class HistoryLog(object):
+    # Every card's readings appended to a memory-mapped file of fixed size records so the
+    # history survives a restart without being held in memory. The file is preallocated for
+    # capacity records, when it's full it is renamed to path.1 (path.1 to path.2 and so on,
+    # keeping keep old files) and a new one started. The header holds a magic string, the
+    # record size, the capacity and how many records are in use.
+    magic = 'GPUDHIS1'
+    header = struct.Struct('<8sIII')
+    record = struct.Struct('<dhhhiiihi')    # time, gpu, then the History columns after time
+
+    def __init__(self, path, capacity=100000, keep=3):
+        self.path = path
+        self.capacity = capacity
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.open()
+
+    def open(self):
+        size = self.header.size + self.capacity * self.record.size
+        fresh = not exists(self.path) or getsize(self.path) != size
+        self.file = open(self.path, 'r+b' if not fresh else 'w+b')
+        if fresh:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        if fresh or self.map[:8] != self.magic:
+            self.count = 0
+            self.header.pack_into(self.map, 0, self.magic, self.record.size, self.capacity, 0)
+        else:
+            self.count = self.header.unpack_from(self.map, 0)[3]
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def rotate(self):
+        self.close()
+        for n in range(self.keep - 1, 0, -1):
+            if exists(self.path + '.' + str(n)):
+                os.rename(self.path + '.' + str(n), self.path + '.' + str(n + 1))
+        os.rename(self.path, self.path + '.1')
+        self.open()
+
+    def append(self, gpu, row):
+        values = [-1 if row[name] is None else row[name] for name, code in History.columns[1:]]
+        with self.lock:
+            if self.count == self.capacity:
+                self.rotate()
+            self.record.pack_into(self.map, self.header.size + self.count * self.record.size,
+                                  row['time'], gpu, *values)
+            self.count += 1
+            self.header.pack_into(self.map, 0, self.magic, self.record.size, self.capacity, self.count)
+
+    def load(self, histories):
+        # Refill the in-memory histories ({gpu: History}) with the newest records from the
+        # current file and, if it doesn't hold enough yet, the one before it.
+        names = [name for name, code in History.columns]
+        need = sum(h.size for h in histories.values())
+        files = [(self.path, need)]
+        if self.count < need:
+            files.insert(0, (self.path + '.1', need - self.count))
+        for path, wanted in files:
+            if not exists(path): continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < self.header.size or data[:8] != self.magic: continue
+            count = min(self.header.unpack_from(data, 0)[3], (len(data) - self.header.size) // self.record.size)
+            for i in range(max(0, count - wanted), count):
+                values = self.record.unpack_from(data, self.header.size + i * self.record.size)
+                if values[1] in histories:
+                    histories[values[1]].append(dict(zip(names, (values[0],) + values[2:])))
+# ----------------------------------------------------------------------------------------
+def sparkline(values, width):
+    # the last width values as a row of bar characters scaled between their min and max,
+    # missing readings (-1) are left blank. Returns the line and the (min, max) it's scaled to.
+    values = values[-width:]
+    known = [v for v in values if v != -1]
+    if not known: return ' ' * width, (0, 0)
+    lo, hi = min(known), max(known)
+    bars = spark_chars
+    line = ''
+    for v in values:
+        if v == -1: line += ' '
+        else: line += bars[int((v - lo) * (len(bars) - 1) / (hi - lo)) if hi > lo else 0]
+    return line.rjust(width), (lo, hi)
+# ----------------------------------------------------------------------------------------
+class Histogram(object):
+    # Latency distribution of one timed operation. Observations are counted in fixed buckets
+    # 25% apart from a microsecond to several minutes so memory stays the same however long
+    # the script runs, a percentile is known to within one bucket.
+    bounds = [1e-6 * 1.25 ** i for i in range(90)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        # upper bound of the bucket the p-th percentile (0-100) falls in, never more than the
+        # largest observation
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return 0.0
+# ----------------------------------------------------------------------------------------
+class Metrics(object):
+    # A Histogram per timed operation, keyed (kind, name). The kinds are 'phase' for the steps
+    # of the loop (sample, control, fan_write, tick, render, flush), 'call' for every call that
+    # reaches the card through TimedBackend and 'nvidia-settings' for every nvidia-settings
+    # process, named after the attributes it queried. Pool threads and the loop thread all
+    # record so updates go through a lock.
+    quantiles = (50, 95, 99)
+    families = (('phase', 'gpu_d_phase_seconds', 'phase', 'time spent in each step of the control loop'),
+                ('call', 'gpu_d_backend_call_seconds', 'call', 'time taken by each call that reaches the card'),
+                ('nvidia-settings', 'gpu_d_nvidia_settings_seconds', 'attributes',
+                 'time taken by each nvidia-settings query process'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, kind, name, seconds):
+        with self.lock:
+            h = self.histograms.get((kind, name))
+            if h is None:
+                h = self.histograms[(kind, name)] = Histogram()
+            h.observe(seconds)
+
+    @contextmanager
+    def timed(self, kind, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time() - start)
+
+    def percentiles(self, kind, name):
+        # (p50, p95, p99) in seconds, None if nothing was timed yet
+        with self.lock:
+            h = self.histograms.get((kind, name))
+            return h and tuple(h.percentile(q) for q in self.quantiles)
+
+    def summary(self, phases):
+        # the --stats line, p50/p95/p99 of the given phases in milliseconds
+        parts = []
+        for name in phases:
+            p = self.percentiles('phase', name)
+            if p: parts.append(name + ' ' + '/'.join('%.3g' % (v * 1000) for v in p))
+        return 'p50/95/99 ms: ' + '  '.join(parts)
+
+    def prometheus(self):
+        # every histogram as a Prometheus summary, see prometheus_report()
+        lines = []
+        with self.lock:
+            for kind, metric, label, text in self.families:
+                names = sorted(name for k, name in self.histograms if k == kind)
+                if not names: continue
+                lines += ['# HELP ' + metric + ' ' + text, '# TYPE ' + metric + ' summary']
+                for name in names:
+                    h = self.histograms[(kind, name)]
+                    labels = label + '="' + prom_escape(name) + '"'
+                    for q in self.quantiles:
+                        lines.append('%s{%s,quantile="%g"} %.9g' % (metric, labels, q / 100, h.percentile(q)))
+                    lines.append('%s_sum{%s} %.9g' % (metric, labels, h.sum))
+                    lines.append('%s_count{%s} %d' % (metric, labels, h.count))
+        return lines
+
+metrics = Metrics()
+# ----------------------------------------------------------------------------------------
+def prom_escape(value):
+    # a Prometheus label value
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+# ----------------------------------------------------------------------------------------
+class GpuController(object):
+    # The control state of one card. Every card has its own target temperature, tolerance and
+    # fan limits, the global defaults unless overridden with --gpu on the command line.
+    # tick() runs on a pool thread so a slow card only holds up its own control period.
+
+    def __init__(self, gpu, target, tolerance, fan_low, fan_high):
+        self.gpu = gpu
+        self.target = target
+        self.tolerance = tolerance
+        self.fan_low = fan_low
+        self.fan_high = fan_high
+        self.current_speed = 0      # fan speed the card accepted last
+        self.speed_delta = 0        # change made by the last tick
+        self.previous_temp = None   # None until the first tick
+        self.temp_delta = 0
+        self.sample = None          # last reading, see sample_keys
+        self.info = None            # static info, see info_keys
+        self.scheduler = AdaptiveScheduler(min_period, max_period, snooze)
+        self.rule = make_rule(fan_rule)     # decides the fan speed, see FanRule
+        self.fan_check = FanFailureDetector()
+        self.fault_exit = False     # set when a dead fan should end the script, see fan_failure()
+        self.governor = LoadGovernor()
+        self.duty = 1.0             # fraction of the time GPU work may run, see --throttle
+        self.applied_duty = 1.0     # the duty apply_throttle() last put into effect
+        self.work = 0.0             # graphics utilization times seconds, the work the card did
+        self.period = snooze        # seconds from the start of this tick to the next
+        self.tick_started = 0
+        self.timer = None           # the event loop timer of the next tick, None while ticking
+        self.due = 0                # when the scheduled tick should start
+        self.overruns = 0           # ticks that started late or outlasted their period
+        self.history = History(history_len)
+
+    def start(self):
+        # switch to manual fan control at 70%, returns False if the card refused. The first
+        # reading is left to the first tick, which follows straight away.
+        self.info = dict.fromkeys(info_keys)
+        self.info.update(backend.info(self.gpu, [k for k in info_keys if k not in live_info_keys]))
+        speed = backend.start(self.gpu, 70)
+        if speed is None:
+            return False
+        self.current_speed = speed
+        if record_file: record_sample(record_file, self.gpu, None, self.info)
+        return True
+
+    def decide(self, current_temp, util, dt):
+        return self.rule.decide(self, current_temp, util, dt)
+
+    def tick(self):
+        previous_tick, self.tick_started = self.tick_started, time()
+        with metrics.timed('phase', 'sample'):
+            sample = backend.read(self.gpu)
+            self.info.update(backend.info(self.gpu, live_info_keys))     # cached, see CachedBackend
+        if record_file: record_sample(record_file, self.gpu, sample)
+        current_temp = sample['temp']
+        if current_temp is None:
+            # the backend couldn't read it, take the card for hot and leave the rule, the fan
+            # failure detector and the governor out of it until it can
+            log.warning('GPU %d: no temperature reading, fan to %d%%', self.gpu, self.fan_high)
+            self.temp_delta = 0
+            new_speed = self.fan_high
+        else:
+            self.temp_delta = 0 if self.previous_temp is None else current_temp - self.previous_temp
+            with metrics.timed('phase', 'control'):
+                new_speed = self.decide(current_temp, utilization(sample), self.tick_started - previous_tick)
+                if self.duty < 1:
+                    new_speed = self.fan_high   # throttled, the fan has nothing left to give
+        self.speed_delta = new_speed - self.current_speed
+        with metrics.timed('phase', 'fan_write'):
+            self.current_speed = backend.set_fan(self.gpu, new_speed)
+        if previous_tick:
+            dt = self.tick_started - previous_tick
+            self.work += utilization(sample) / 100 * dt
+            if current_temp is not None:
+                self.fan_check.update(self, sample, dt)
+                if throttle_mode: self.duty = self.governor.update(self, current_temp, dt)
+        if current_temp is not None: self.previous_temp = current_temp
+        util_delta = abs(utilization(sample) - utilization(self.sample))
+        out_of_band = current_temp is None or abs(current_temp - self.target) > self.tolerance
+        self.period = self.scheduler.update(self.temp_delta, util_delta, out_of_band)
+        self.sample = sample
+        row = history_row(self)
+        self.history.append(row)
+        if history_log: history_log.append(self.gpu, row)
+# ----------------------------------------------------------------------------------------
+def start_card(c):
+    # c.start() for the startup pool, a card that raises counts as one that refused
+    try:
+        return c.start()
+    except Exception:
+        log.exception('GPU %d: cannot switch to manual fan control', c.gpu)
+        return False
+# ----------------------------------------------------------------------------------------
+def make_controllers(gpus, spec):
+    # spec is the value of --gpu, a comma separated list of gpu:target[:tolerance[:low[:high]]]
+    # overrides, cards not mentioned get the global defaults
+    overrides = {}
+    for item in (spec or '').split(','):
+        if not item: continue
+        fields = [int(v) for v in item.split(':')]
+        overrides[fields[0]] = fields[1:]
+    result = []
+    for gpu in gpus:
+        settings = overrides.get(gpu, [])
+        settings = settings + [target_temp, tolerance, fan_speed_low_lim, fan_speed_up_lim][len(settings):]
+        result.append(GpuController(gpu, *settings))
+    return result
+# ----------------------------------------------------------------------------------------
+def chek_new_speed(speed, low_lim = None, up_lim = None):
+    # speed must be between 1 and 100 else nvidia-settings rejects it
+    if low_lim is None: low_lim = fan_speed_low_lim
+    if up_lim is None: up_lim = fan_speed_up_lim
+    if speed > up_lim: return(up_lim) 
+    elif speed < low_lim: return (low_lim)
     else: return (speed)
 # ----------------------------------------------------------------------------------------    
+def restore_fans():
+    # set fan speed to max, return fan speed control to auto state, lift any --throttle. A card
+    # that fails doesn't stop the others getting theirs back.
+    if throttle_mode:
+        for c in controllers: c.duty = 1.0
+        apply_throttle()
+    for c in controllers:
+        try:
+            backend.set_fan(c.gpu, c.fan_high)
+            backend.set_fan_control(c.gpu, False)
+        except Exception:
+            log.exception('GPU %d: cannot restore automatic fan control', c.gpu)
+# ----------------------------------------------------------------------------------------
 def safe_exit(err_code):
-    # set fan speed to max, return fan speed control to auto state, exit
-    set_speed(fan_speed_up_lim)
-    s = check_output(['nvidia-settings', '--assign', 'localhost:0[gpu:0]/GPUFanControlState=0'])
+    restore_fans()
     exit (err_code)
+# ----------------------------------------------------------------------------------------
+def size_window():
+    # place, size and title the terminal window
+    check_output(['wmctrl', '-r', ':ACTIVE:', '-e', '0,' + str(x_loc) + ',' + str(y_loc) + ',' + str(x_pix) + ',' + str(y_pix)])
+    check_output(['wmctrl', '-r', ':ACTIVE:', '-T', 'Dag\'s not too fancy NVIDIA temperature monitor'])
+# ----------------------------------------------------------------------------------------    
+def split_options(args):
+    # separate --name and --name=value options from the positional args, returns
+    # ({name: value or True}, positional args)
+    options, rest = {}, []
+    for a in args:
+        if a.startswith('--'):
+            name, eq, value = a[2:].partition('=')
+            options[name] = value if eq else True
+        else:
+            rest.append(a)
+    return options, rest
 # ----------------------------------------------------------------------------------------    
 def print_usage():
     print'\n#######################################################################################\n'
     print 'Usage:'
     print '   python nvidiatmon.py target_temp width height' 
+    print '   python nvidiatmon.py target_temp --daemon' 
+    print '   python nvidiatmon.py --fleet=host:port,host:port,...' 
     print
     print '   where: target_temp = an integer, the temperature at which you want your GPU to run'
     print '          width = an integer, the desired width of the terminal window in pixels'
@@ -330,6 +2473,58 @@ def print_usage():
     print
     print 'Example:'
     print '   python nvidiatmon.py 70 475 340'
+    print
+    print 'Options:'
+    print '   --daemon                             no screen output, just control the fans and log'
+    print '                                        to stdout, for running under systemd. SIGTERM'
+    print '                                        restores automatic fan control and exits'
+    print '   --verbose                            with --daemon, log every reading'
+    print '   --backend=nvidia-settings[:display]  read/control the card with nvidia-settings (default)'
+    print '   --backend=nvml                       use libnvidia-ml in-process, needs root to set fans'
+    print '   --backend=hwmon[:hwmonN,...]         use /sys/class/hwmon (nouveau, amdgpu, radeon)'
+    print '   --backend=replay:trace_file          play back a trace recorded with --record'
+    print '   --backend=sim[:profile,...]          simulated cards, one per load profile, profiles are'
+    print '                                        ' + ', '.join(sorted(load_profiles))
+    print '   --record=trace_file                  append every reading to trace_file'
+    print '   --server=[host:]port                 serve readings, history and target changes as'
+    print '                                        JSON over HTTP, host defaults to 127.0.0.1'
+    print '   --fleet=host:port,...                no local control, show every card of the listed'
+    print '                                        --server hosts in one table'
+    print '   --history-log=file                   keep every reading in a memory-mapped, rotated log'
+    print '                                        so the history survives restarts'
+    print '   --fps=n                              screen updates per second at most, default ' + str(frame_rate)
+    print '   --stats                              show tick, sample, fan write and render latency'
+    print '                                        percentiles and period overruns on the bottom line'
+    print '   --metrics-file=file                  write timings and counters in Prometheus text'
+    print '                                        format to file every ' + str(metrics_period) + ' seconds and at exit,'
+    print '                                        --server also serves them as GET /metrics'
+    print '   --min-period=seconds                 control period while temperature or load is'
+    print '                                        changing, default ' + str(min_period)
+    print '   --max-period=seconds                 longest control period while readings are stable,'
+    print '                                        default ' + str(max_period) + ', at most ' + str(AdaptiveScheduler.safety_period)
+    print '   --slow-ttl=seconds                   how long slowly changing readings like used'
+    print '                                        memory are cached, default 10'
+    print '   --controller=step                    the original fan speed rule (default)'
+    print '   --controller=pid[:kp[:ki[:kd[:ff]]]] PID with utilization feed-forward, default gains'
+    print '                                        ' + ':'.join('%g' % g for g in PidRule.__init__.func_defaults)
+    print '   --on-fan-failure=action,...          what to do when a card stays hot while its fan turns'
+    print '                                        far too slowly: alarm (log it and beep, default),'
+    print '                                        boinc (suspend BOINC GPU work), exit (full fan,'
+    print '                                        automatic control, exit), none or hook:command (run'
+    print '                                        command, must come last)'
+    print '   --fan-confirm=seconds                how long a fan must look dead, default ' + str(fan_confirm)
+    print '   --throttle=mode                      when a card stays above its band with the fan at'
+    print '                                        its limit, cut its load in steps instead: boinc'
+    print '                                        (duty-cycle BOINC GPU work), power (lower the power'
+    print '                                        limit, nvml and hwmon backends), hook:command (run'
+    print '                                        command with GPU_D_DUTY set) or none (default)'
+    print '   --throttle-period=seconds            how often the duty is applied, the length of a'
+    print '                                        BOINC duty cycle, default ' + str(throttle_period)
+    print '   --rescan                             probe the cards even if the capability manifest'
+    print '                                        (' + join(manifest_dir, 'manifest.json') + ') knows them'
+    print '   --gpu=gpu:target[:tolerance[:low[:high]]],...'
+    print '                                        per GPU target temperature, tolerance and fan'
+    print '                                        speed limits, e.g. --gpu=1:65,2:70:2:50:80'
     print '\nNote:'
     print '   If the width or height parameter is too small the script will crash. The values of'
     print '   475 and 300 work for my screen resolution but not necessarily yours. If in doubt'
@@ -360,61 +2555,148 @@ def print_disclaimer():
         
 # ###############################    "main()" starts here    ############################
 
-print title
-print
-if not exists('/usr/bin/wmctrl'):
-    #print 'Package "wmctrl" is not installed. Please execute "sudo apt-get install wmctrl"'
-    if raw_input('Package "wmctrl" is not installed.\nDo you wish to install it now? (y/n) ').lower() == 'y':
-        x = check_output(['sudo', 'apt-get', '-y', 'install', 'wmctrl'])
+if __name__ == '__main__':
+    # check command line args, --name[=value] options can go anywhere
+    options, argv = split_options(argv)
+    daemon = options.get('daemon')
+
+    if options.get('fleet'):
+        # the aggregator doesn't touch any local card
+        try:
+            frame_rate = max(0.1, float(options.get('fps', frame_rate)))
+            hosts = options['fleet'].split(',')
+            for h in hosts: parse_address(h, 'localhost')
+        except ValueError:
+            print_usage()
+            exit(1)
+        locale.setlocale(locale.LC_ALL, '')
+        curses.wrapper(run_fleet, hosts)
+        exit(0)
+
+    if daemon:
+        logging.basicConfig(stream=stdout, format='%(levelname)s %(message)s',
+                            level=logging.DEBUG if options.get('verbose') else logging.INFO)
     else:
-        exit(1) 
-
-# check command line args
-if len(argv) < 2:
-    print_usage()
-    exit(1)
-
-if argv[1].isdigit():
-    target_temp = int(argv[1])
-else:
-    print_usage()
-    exit(1)
-
-#if len(argv) == 3 and (not argv[2] == 'C' and not argv[2] == 'c'):
-#        print_disclaimer()
-
-if argv[2].isdigit():
-    x_pix = int(argv[2])
-else: 
-    print_usage()
-    exit(1)
-
-if argv[3].isdigit():
-    y_pix = int(argv[3])
-else: 
-    print_usage()
-    exit(1)
-        
-if target_temp > 85:
-    print 'Target temperature ' + str(target_temp) + ' Celsius is too high. Please choose a lower target temperature, exiting.'
-    print
-    exit(1)
+        # warnings while starting up (a card left to the driver etc.) go to the terminal until
+        # curses takes it over
+        startup_log = logging.StreamHandler(stdout)
+        startup_log.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        startup_log.setLevel(logging.WARNING)
+        log.addHandler(startup_log)
+        print title
+        print
+        if not exists('/usr/bin/wmctrl'):
+            #print 'Package "wmctrl" is not installed. Please execute "sudo apt-get install wmctrl"'
+            if raw_input('Package "wmctrl" is not installed.\nDo you wish to install it now? (y/n) ').lower() == 'y':
+                x = check_output(['sudo', 'apt-get', '-y', 'install', 'wmctrl'])
+            else:
+                exit(1) 
 
-# inputs seem OK, try switch to manual fan speed control mode
-s = check_output(['nvidia-settings', '--assign', 'localhost:0[gpu:0]/GPUFanControlState=1'])
+    if len(argv) < 2:
+        print_usage()
+        exit(1)
 
-# check if fan speed control is in manual mode 
-s = check_output(['nvidia-settings', '--query', 'localhost:0[gpu:0]/GPUFanControlState', '--terse'])
-s = s.strip('\n').strip(' ')
+    if argv[1].isdigit():
+        target_temp = int(argv[1])
+    else:
+        print_usage()
+        exit(1)
 
-if not s == '1':
-    print 'ERROR: failed switch to manual fan speed control mode, exiting.'
-    safe_exit(1)
-    print
-else:
-    current_speed = set_speed(70)
-    previous_temp = get_temp()
-    temp_delta = 0
-    x = check_output(['wmctrl', '-r', ':ACTIVE:', '-e', '0,' + str(x_loc) + ',' + str(y_loc) + ',' + str(x_pix) + ',' + str(y_pix)])
-    x = check_output(['wmctrl', '-r', ':ACTIVE:', '-T', 'Dag\'s not too fancy NVIDIA temperature monitor']) 
-    curses.wrapper(monitor)
+    #if len(argv) == 3 and (not argv[2] == 'C' and not argv[2] == 'c'):
+    #        print_disclaimer()
+
+    if daemon:
+        pass                    # no window to size
+    elif len(argv) > 3 and argv[2].isdigit() and argv[3].isdigit():
+        x_pix = int(argv[2])
+        y_pix = int(argv[3])
+    else: 
+        print_usage()
+        exit(1)
+
+    if target_temp > 85:
+        print 'Target temperature ' + str(target_temp) + ' Celsius is too high. Please choose a lower target temperature, exiting.'
+        print
+        exit(1)
+
+    try:
+        backend_spec = options.get('backend', 'nvidia-settings')
+        backend = CachedBackend(TimedBackend(make_backend(backend_spec)), float(options.get('slow-ttl', 10)))
+    except ValueError:
+        print_usage()
+        exit(1)
+    except BackendError as e:
+        print 'ERROR: ' + str(e) + ', exiting.'
+        exit(1)
+
+    try:
+        min_period = float(options.get('min-period', min_period))
+        max_period = float(options.get('max-period', max_period))
+        frame_rate = max(0.1, float(options.get('fps', frame_rate)))
+        fan_rule = options.get('controller', fan_rule)
+        fault_actions = parse_fault_actions(options.get('on-fan-failure', ','.join(fault_actions)))
+        fan_confirm = float(options.get('fan-confirm', fan_confirm))
+        if not fan_confirm > 0: raise ValueError('--fan-confirm must be positive')
+        throttle_mode = parse_throttle(options.get('throttle', 'none'))
+        throttle_period = float(options.get('throttle-period', throttle_period))
+        if not throttle_period > 0: raise ValueError('--throttle-period must be positive')
+        show_stats = bool(options.get('stats'))
+        if options.get('metrics-file'):
+            metrics_file = options['metrics-file']
+        if options.get('server'):
+            server_address = parse_address(options['server'], '127.0.0.1')
+        driver = nvidia_driver_version()
+        cards = nvidia_cards()
+        manifest = None if options.get('rescan') or not driver else load_manifest(backend_spec, driver, cards)
+        if manifest:
+            gpus = backend.restore(manifest)
+        else:
+            gpus = backend.devices()
+            if driver: manifest_pending = (backend_spec, driver, cards)
+        controllers = make_controllers(gpus, options.get('gpu'))
+    except ValueError:
+        print_usage()
+        exit(1)
+    except (CalledProcessError, EnvironmentError, BackendError) as e:
+        # no X server on the display, the tool missing, no card to manage
+        print 'ERROR: finding the GPUs: ' + str(e) + ', exiting.'
+        exit(1)
+
+    for c in controllers:
+        if c.target > 85:
+            print 'Target temperature ' + str(c.target) + ' Celsius for GPU ' + str(c.gpu) + ' is too high. Please choose a lower target temperature, exiting.'
+            print
+            exit(1)
+
+    if options.get('record'):
+        record_file = open(options['record'], 'a')
+
+    if options.get('history-log'):
+        history_log = HistoryLog(options['history-log'])
+        history_log.load(dict((c.gpu, c.history) for c in controllers))
+
+    # inputs seem OK, try switch every card to manual fan speed control mode and check it took.
+    # The cards are started all at once and, on the screen, the window is sized meanwhile.
+    pool = ThreadPool(len(controllers) + 1)
+    if not daemon:
+        window = pool.apply_async(size_window)
+    for c, ok in zip(controllers, pool.map(start_card, controllers)):
+        if not ok:
+            print 'ERROR: failed switch GPU ' + str(c.gpu) + ' to manual fan speed control mode, exiting.'
+            safe_exit(1)
+
+    if daemon:
+        pool.close()
+        run_daemon()
+    else:
+        window.get()
+        pool.close()
+        locale.setlocale(locale.LC_ALL, '')
+        if locale.getpreferredencoding() == 'UTF-8':
+            spark_chars = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+        log.removeHandler(startup_log)
+        try:
+            curses.wrapper(monitor)
+        finally:
+            restore_fans()      # on q, a fan failure exit or an error alike
+        exit(2 if any(c.fault_exit for c in controllers) else 0)